@@ -19,7 +19,101 @@ class NetBoxDDNSConfig(PluginConfig):
     description = 'Dynamic DNS Connector for NetBox'
     base_url = 'ddns'
     required_settings = []
-    default_settings = {}
+    default_settings = {
+        # Look up zones in a per-process in-memory index instead of querying the database for every update
+        'zone_cache': True,
+
+        # Seconds between checks whether another process invalidated the shared caches
+        'cache_check_interval': 1.0,
+
+        # Cache zone cuts found by SOA lookups, honouring their TTLs up to a maximum
+        'soa_cache': True,
+        'soa_cache_max_ttl': 3600,
+        'soa_cache_negative_ttl': 60,
+
+        # Seconds to cache the resolved addresses of DDNS servers, and how long to cache resolution failures
+        'address_cache_ttl': 300,
+        'address_cache_negative_ttl': 30,
+
+        # Bulk updates: operations per background job, and limits for packing records into one UPDATE message.
+        # Messages that are larger than udp_max_size are sent over TCP.
+        'batch_size': 500,
+        'update_max_records': 500,
+        'update_max_size': 32768,
+        'udp_max_size': 512,
+
+        # How updates are sent: 'tcp' keeps a pooled connection per server and pipelines messages over it, 'udp'
+        # sends each message separately and only falls back to TCP for large or truncated messages
+        'transport': 'tcp',
+        'update_timeout': 10.0,
+        'tcp_idle_timeout': 25.0,
+        'pipeline_depth': 16,
+
+        # Connections used in parallel per DDNS server, and threads available for sending over them in each worker
+        'server_concurrency': 4,
+        'dispatch_workers': 32,
+
+        # Adaptive rate limit per DDNS server, shared by all workers. Starts at rate_initial UPDATE messages per second
+        # with bursts of rate_burst, grows by rate_increase per second while updates succeed and is multiplied by
+        # rate_decrease when the server answers SERVFAIL or REFUSED or times out. A server's maximum rate overrides
+        # rate_max.
+        'rate_limit': True,
+        'rate_initial': 50.0,
+        'rate_burst': 20,
+        'rate_increase': 5.0,
+        'rate_decrease': 0.5,
+        'rate_min': 1.0,
+        'rate_max': 1000.0,
+
+        # Open the circuit breaker of a DDNS server after this many updates in a row got no response, 0 to disable.
+        # Work for the server is parked until a probe, sent every breaker_reset_timeout seconds, gets an answer.
+        'breaker_threshold': 5,
+        'breaker_reset_timeout': 30,
+
+        # Seconds to wait for more changes to the same IP address or extra name before updating DNS
+        'coalesce_window': 1.0,
+
+        # Transactions that change more objects than this, like bulk imports and edits, are sent as bulk jobs
+        'bulk_threshold': 10,
+
+        # Resyncing all records of a zone: records per chunk, and the time limit and retries of the job for each chunk
+        'resync_chunk_size': 1000,
+        'resync_job_timeout': 3600,
+        'resync_retries': 3,
+
+        # Results of updates are saved in bulk, when this many are waiting or the oldest has waited this many seconds,
+        # and always at the end of each background job
+        'status_flush_size': 500,
+        'status_flush_interval': 5.0,
+
+        # Bearer token that Prometheus can use to scrape the metrics, without it only logged in users can see them
+        'metrics_token': None,
+
+        # Reconciling a zone with AXFR: time limit for the transfer, and which records on the server that NetBox
+        # doesn't know about are deleted: 'none', 'managed' (only for names NetBox manages) or 'all'
+        'axfr_timeout': 300,
+        'reconcile_prune': 'none',
+
+        # Incremental syncs leave change log entries younger than this many seconds for the next run, so changes
+        # of transactions that haven't committed yet aren't skipped
+        'changelog_delay': 300,
+
+        # Don't send records again that have already been added exactly like this, unless an update is forced
+        'skip_unchanged': True,
+
+        # Seconds to keep the results of background jobs in Redis, 0 to discard them and -1 to keep them forever
+        'result_ttl': 500,
+
+        # RQ queues for interactive work (single edits, the recreate button, probes) and for bulk work (bulk edits,
+        # resyncs, reconciles, parked work). NetBox always has the 'high', 'default' and 'low' queues.
+        'interactive_queue': 'high',
+        'bulk_queue': 'low',
+
+        # Bulk edits queue as many bulk jobs as fit below throttle_bulk_depth waiting jobs, and schedule the others in
+        # groups of throttle_bulk_depth jobs, throttle_bulk_interval seconds apart
+        'throttle_bulk_depth': 100,
+        'throttle_bulk_interval': 10,
+    }
 
     def ready(self):
         super().ready()
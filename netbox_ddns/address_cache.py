@@ -0,0 +1,101 @@
+import logging
+import socket
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .utils import get_config
+
+logger = logging.getLogger('netbox_ddns')
+
+# Weight of a new round-trip time measurement in the moving average
+RTT_SMOOTHING = 0.3
+
+
+class _Entry:
+    __slots__ = ('addresses', 'error', 'expires', 'refresh_at', 'refreshing')
+
+    def __init__(self, addresses: List[str], error: Optional[Exception], ttl: float):
+        now = time.monotonic()
+        self.addresses = addresses
+        self.error = error
+        self.expires = now + ttl
+        self.refresh_at = now + ttl * 0.75
+        self.refreshing = False
+
+
+class ServerAddressCache:
+    """
+    Resolves DDNS server names with getaddrinfo and caches the result per process. Entries are refreshed in the
+    background before they expire, failures are cached for a short time, and when a name has multiple addresses
+    the one with the lowest observed round-trip time is used.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, int], _Entry] = {}
+        self._rtts: Dict[str, float] = {}
+
+    def _lookup(self, key: Tuple[str, int]) -> _Entry:
+        host, port = key
+        try:
+            addrinfo = socket.getaddrinfo(host, port, proto=socket.IPPROTO_UDP)
+            addresses = []
+            for family, _, _, _, sockaddr in addrinfo:
+                if family in (socket.AF_INET, socket.AF_INET6) and sockaddr[0] and sockaddr[0] not in addresses:
+                    addresses.append(sockaddr[0])
+            entry = _Entry(addresses, None, get_config('address_cache_ttl'))
+        except OSError as e:
+            logger.warning(f"Can't resolve DDNS server {host}: {e}")
+            entry = _Entry([], e, get_config('address_cache_negative_ttl'))
+
+        with self._lock:
+            old = self._entries.get(key)
+            if entry.error and old and old.addresses and old.expires > time.monotonic():
+                # Keep using the addresses we have until they expire
+                old.refreshing = False
+                return old
+
+            self._entries[key] = entry
+
+        return entry
+
+    def _refresh(self, key: Tuple[str, int]):
+        try:
+            self._lookup(key)
+        except Exception:
+            logger.exception(f"Background refresh of DDNS server {key[0]} failed")
+
+    def get_addresses(self, host: str, port: int) -> List[str]:
+        key = (host, port)
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is None or now >= entry.expires:
+            entry = self._lookup(key)
+        elif now >= entry.refresh_at and not entry.refreshing:
+            entry.refreshing = True
+            threading.Thread(target=self._refresh, args=(key,), daemon=True).start()
+
+        if entry.error:
+            raise entry.error
+
+        return entry.addresses
+
+    def resolve(self, host: str, port: int) -> Optional[str]:
+        addresses = self.get_addresses(host, port)
+        if not addresses:
+            return None
+
+        # Unmeasured addresses count as fastest, so every address gets tried before settling on the best one
+        return min(addresses, key=lambda address: self._rtts.get(address, 0.0))
+
+    def record_rtt(self, address: str, rtt: float):
+        old = self._rtts.get(address)
+        self._rtts[address] = rtt if old is None else old + RTT_SMOOTHING * (rtt - old)
+
+    def flush(self):
+        with self._lock:
+            self._entries.clear()
+
+
+server_addresses = ServerAddressCache()
@@ -4,16 +4,17 @@ from django.contrib import admin, messages
 from django.contrib.admin.filters import SimpleListFilter
 from django.contrib.admin.options import ModelAdmin
 from django.db.models import QuerySet
-from django.db.models.query_utils import Q
 from django.http.request import HttpRequest
+from django.utils.html import format_html, format_html_join
 from django.utils.translation import gettext_lazy as _
 
-from ipam.models import IPAddress
 from netbox.admin import admin_site
-from netbox_ddns.models import DNSStatus, ExtraDNSName
-from .background_tasks import dns_create
-from .models import ReverseZone, Server, Zone
-from .utils import normalize_fqdn
+from netbox_ddns.models import ExtraDNSName
+from .metrics import server_summary
+from .models import ReverseZone, Server, SyncWatermark, Zone
+from .reconcile import dns_reconcile_zone
+from .resync import KIND_FORWARD, KIND_REVERSE, enqueue_resync
+from .utils import delegation_cache
 
 logger = logging.getLogger('netbox_ddns')
 
@@ -45,112 +46,99 @@ class ReverseZoneInlineAdmin(admin.TabularInline):
 
 @admin.register(Server, site=admin_site)
 class ServerAdmin(admin.ModelAdmin):
-    list_display = ('server', 'server_port', 'tsig_key_name', 'tsig_algorithm')
+    list_display = ('server', 'server_port', 'tsig_key_name', 'tsig_algorithm', 'max_rate', 'average_job_time')
+    readonly_fields = ('timing_summary',)
     inlines = [
         ZoneInlineAdmin,
         ReverseZoneInlineAdmin,
     ]
 
+    def average_job_time(self, obj: Server):
+        count, summary = server_summary(obj.pk)
+        if not count:
+            return '-'
+        return f"{summary['total'][0] * 1000:.1f} ms"
 
-@admin.register(Zone, site=admin_site)
-class ZoneAdmin(admin.ModelAdmin):
-    list_display = ('name', 'ttl', 'server')
-    actions = [
-        'update_all_records'
-    ]
-
-    def update_all_records(self, request: HttpRequest, queryset: QuerySet):
-        for zone in queryset:
-            counter = 0
-
-            # Find all more-specific zones
-            more_specifics = Zone.objects.filter(name__endswith=zone.name).exclude(pk=zone.pk)
+    average_job_time.short_description = _('Average job time')
 
-            # Find all IPAddress objects in this zone but not in the more-specifics
-            ip_addresses = IPAddress.objects.filter(Q(dns_name__endswith=zone.name) |
-                                                    Q(dns_name__endswith=zone.name.rstrip('.')))
-            for more_specific in more_specifics:
-                ip_addresses = ip_addresses.exclude(Q(dns_name__endswith=more_specific.name) |
-                                                    Q(dns_name__endswith=more_specific.name.rstrip('.')))
+    def timing_summary(self, obj: Server):
+        count, summary = server_summary(obj.pk) if obj.pk else (0, {})
+        if not count:
+            return _('No recent jobs')
 
-            for ip_address in ip_addresses:
-                new_address = ip_address.address.ip
-                new_dns_name = normalize_fqdn(ip_address.dns_name)
+        rows = format_html_join('', '<tr><td>{}</td><td>{} ms</td><td>{} ms</td></tr>', (
+            (phase, f'{mean * 1000:.1f}', f'{p95 * 1000:.1f}') for phase, (mean, p95) in summary.items()
+        ))
+        return format_html('<table><tr><th>{}</th><th>{}</th><th>{}</th></tr>{}</table><p>{}</p>',
+                           _('Phase'), _('Mean'), _('95th percentile'), rows,
+                           _('Over the last {count} jobs').format(count=count))
 
-                if new_dns_name:
-                    status, created = DNSStatus.objects.get_or_create(ip_address=ip_address)
+    timing_summary.short_description = _('Where the time goes')
 
-                    dns_create.delay(
-                        dns_name=new_dns_name,
-                        address=new_address,
-                        status=status,
-                        reverse=False,
-                    )
 
-                    counter += 1
+class ZoneActionsMixin:
+    """
+    The admin actions of forward and reverse zones, for the kind of zone set in zone_kind
+    """
+    zone_kind = KIND_FORWARD
+    updating_message = _("Updating all forward records in {name}")
+    already_updating_message = _("Forward records in {name} are already being updated")
 
-            # Find all ExtraDNSName objects in this zone but not in the more-specifics
-            extra_names = ExtraDNSName.objects.filter(name__endswith=zone.name)
-            for more_specific in more_specifics:
-                extra_names = extra_names.exclude(name__endswith=more_specific.name)
-
-            for extra in extra_names:
-                new_address = extra.ip_address.address.ip
-                new_dns_name = extra.name
-
-                dns_create.delay(
-                    dns_name=new_dns_name,
-                    address=new_address,
-                    status=extra,
-                    reverse=False,
-                )
+    actions = [
+        'update_all_records',
+        'force_update_all_records',
+        'reconcile_records',
+        'flush_delegation_cache',
+    ]
 
-                counter += 1
+    def reconcile_records(self, request: HttpRequest, queryset: QuerySet):
+        for zone in queryset:
+            dns_reconcile_zone.delay(self.zone_kind, zone.pk)
+            messages.info(request, _("Reconciling {name} with its DNS server").format(name=zone.name))
 
-            messages.info(request, _("Updating {count} forward records in {name}").format(count=counter,
-                                                                                          name=zone.name))
+    reconcile_records.short_description = _('Reconcile with the DNS server, only sending differences')
 
+    def update_all_records(self, request: HttpRequest, queryset: QuerySet, force: bool = False):
+        for zone in queryset:
+            if enqueue_resync(self.zone_kind, zone.pk, force=force):
+                messages.info(request, self.updating_message.format(name=zone.name))
+            else:
+                messages.warning(request, self.already_updating_message.format(name=zone.name))
 
-@admin.register(ReverseZone, site=admin_site)
-class ReverseZoneAdmin(admin.ModelAdmin):
-    list_display = ('prefix', 'name', 'ttl', 'server')
-    list_filter = [IPFamilyFilter]
-    actions = [
-        'update_all_records'
-    ]
+    update_all_records.short_description = _('Update all records that have changed')
 
-    def update_all_records(self, request: HttpRequest, queryset: QuerySet):
-        for zone in queryset:
-            counter = 0
+    def force_update_all_records(self, request: HttpRequest, queryset: QuerySet):
+        self.update_all_records(request, queryset, force=True)
 
-            # Find all more-specific zones
-            more_specifics = ReverseZone.objects.filter(prefix__net_contained=zone.prefix).exclude(pk=zone.pk)
+    force_update_all_records.short_description = _('Force update all records, also unchanged ones')
 
-            # Find all IPAddress objects in this zone but not in the more-specifics
-            ip_addresses = IPAddress.objects.filter(address__net_contained_or_equal=zone.prefix)
-            for more_specific in more_specifics:
-                ip_addresses = ip_addresses.exclude(address__net_contained_or_equal=more_specific.prefix)
+    def flush_delegation_cache(self, request: HttpRequest, queryset: QuerySet):
+        delegation_cache.flush()
+        messages.info(request, _("Flushed the delegation cache of all workers"))
 
-            for ip_address in ip_addresses:
-                new_address = ip_address.address.ip
-                new_dns_name = normalize_fqdn(ip_address.dns_name)
+    flush_delegation_cache.short_description = _('Flush the delegation cache after re-delegating a zone')
 
-                if new_dns_name:
-                    status, created = DNSStatus.objects.get_or_create(ip_address=ip_address)
 
-                    dns_create.delay(
-                        dns_name=new_dns_name,
-                        address=new_address,
-                        status=status,
-                        forward=False,
-                    )
+@admin.register(Zone, site=admin_site)
+class ZoneAdmin(ZoneActionsMixin, admin.ModelAdmin):
+    list_display = ('name', 'ttl', 'server')
 
-                    counter += 1
 
-            messages.info(request, _("Updating {count} reverse records in {name}").format(count=counter,
-                                                                                          name=zone.name))
+@admin.register(ReverseZone, site=admin_site)
+class ReverseZoneAdmin(ZoneActionsMixin, admin.ModelAdmin):
+    list_display = ('prefix', 'name', 'ttl', 'server')
+    list_filter = [IPFamilyFilter]
+    zone_kind = KIND_REVERSE
+    updating_message = _("Updating all reverse records in {name}")
+    already_updating_message = _("Reverse records in {name} are already being updated")
 
 
 @admin.register(ExtraDNSName, site=admin_site)
 class ExtraDNSNameAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(SyncWatermark, site=admin_site)
+class SyncWatermarkAdmin(admin.ModelAdmin):
+    list_display = ('name', 'last_change_id', 'last_update')
+    readonly_fields = ('last_update',)
@@ -1,3 +1,4 @@
+from django.urls import path
 from netbox.api.routers import NetBoxRouter
 from . import views
 
@@ -7,4 +8,6 @@ app_name = 'netbox_ddns'
 router = NetBoxRouter()
 router.register('extra-dns-name', views.ExtraDNSNameViewSet)
 
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
+]
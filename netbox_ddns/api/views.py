@@ -1,6 +1,12 @@
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
 from netbox.api.viewsets import NetBoxModelViewSet
+from rest_framework.views import APIView
+
 from ..filtersets import ExtraDNSNameFilterSet
+from ..metrics import render as render_metrics
 from ..models import ExtraDNSName
+from ..utils import get_config
 from .serializers import ExtraDNSNameSerializer
 
 
@@ -8,3 +14,23 @@ class ExtraDNSNameViewSet(NetBoxModelViewSet):
     queryset = ExtraDNSName.objects.all()
     serializer_class = ExtraDNSNameSerializer
     filterset_class = ExtraDNSNameFilterSet
+
+
+class MetricsView(APIView):
+    """
+    Metrics in the Prometheus text format, for scrapers that send the metrics_token as bearer token and for users
+    with a NetBox API token or session that may view DDNS servers. The API isn't subject to LOGIN_REQUIRED, so
+    scrapers aren't redirected to the login page.
+    """
+    permission_classes = []
+
+    # noinspection PyMethodMayBeStatic
+    def get(self, request):
+        token = get_config('metrics_token')
+        if not token or not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            if not request.user.is_authenticated:
+                return HttpResponse(status=401)
+            if not request.user.has_perm('netbox_ddns.view_server'):
+                return HttpResponse(status=403)
+
+        return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,16 +1,24 @@
 import logging
-from typing import List, Optional
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
 
-import dns.query
+import dns.message
 import dns.rdatatype
 import dns.resolver
-from django.db import IntegrityError
-from django_rq import job
 from dns import rcode
 from netaddr import ip
 
-from netbox_ddns.models import ACTION_CREATE, ACTION_DELETE, DNSStatus, RCODE_NO_ZONE, ReverseZone, Zone
-from netbox_ddns.utils import get_soa
+from netbox_ddns.batch import PendingRecord
+from netbox_ddns.breaker import breaker, park
+from netbox_ddns.dispatcher import DispatchError, dispatch
+from netbox_ddns.lookup import reverse_zone_index, zone_index
+from netbox_ddns.metrics import metrics
+from netbox_ddns.models import ACTION_CREATE, ACTION_DELETE, DNSStatus, RCODE_NO_ZONE, ReverseZone
+from netbox_ddns.payload import CompactOperation, CompactRecord, StatusRef, pack_records, unpack_operations, \
+    unpack_records
+from netbox_ddns.queues import PRIORITY_BULK, plugin_job
+from netbox_ddns.utils import get_config, get_soa
+from netbox_ddns.writeback import status_writer
 
 logger = logging.getLogger('netbox_ddns')
 
@@ -28,173 +36,311 @@ def status_update(output: List[str], operation: str, response) -> None:
     output.append(message)
 
 
-def create_forward(dns_name: str, address: ip.IPAddress, status: Optional[DNSStatus], output: List[str]):
+def plan_forward(action: int, dns_name: str, address: ip.IPAddress, status: Optional[DNSStatus]) \
+        -> Optional[PendingRecord]:
     if status:
-        status.forward_action = ACTION_CREATE
+        status.forward_action = action
 
-    zone = Zone.objects.find_for_dns_name(dns_name)
+    start = time.monotonic()
+    zone = zone_index.find(dns_name)
+    metrics.add_phase('zone_lookup', time.monotonic() - start, zone.server if zone else None)
     if zone:
         logger.debug(f"Found zone {zone.name} for {dns_name}")
 
         # Check the SOA, we don't want to write to a parent zone if it has delegated authority
-        soa = get_soa(zone.name)
+        with metrics.soa_timer(), metrics.phase('soa', zone.server):
+            soa = get_soa(zone.name)
         if soa == zone.name:
             record_type = 'A' if address.version == 4 else 'AAAA'
-            update = zone.server.create_update(zone.name)
-            update.add(
-                dns_name,
-                zone.ttl,
-                record_type,
-                str(address)
+            if action == ACTION_CREATE:
+                operation = f'Adding {dns_name} {record_type} {address}'
+            else:
+                operation = f'Deleting {dns_name} {record_type} {address}'
+
+            return PendingRecord(
+                server=zone.server,
+                zone_name=zone.name,
+                action=action,
+                name=dns_name,
+                ttl=zone.ttl,
+                rdtype=record_type,
+                rdata=str(address),
+                status=status,
+                status_field='forward_rcode',
+                operation=operation,
             )
-            response = dns.query.udp(update, zone.server.address, port=zone.server.server_port)
-            status_update(output, f'Adding {dns_name} {record_type} {address}', response)
-            if status:
-                status.forward_rcode = response.rcode()
         else:
             logger.warning(f"Can't update zone {zone.name} for {dns_name}, "
                            f"it has delegated authority for {soa}")
+            metrics.record_unsent(zone.server, zone.name, rcode.NOTAUTH)
             if status:
                 status.forward_rcode = rcode.NOTAUTH
     else:
         logger.debug(f"No zone found for {dns_name}")
+        metrics.record_unsent(None, '', RCODE_NO_ZONE)
         if status:
             status.forward_rcode = RCODE_NO_ZONE
 
 
-def delete_forward(dns_name: str, address: ip.IPAddress, status: Optional[DNSStatus], output: List[str]):
-    if status:
-        status.forward_action = ACTION_DELETE
+# A reverse zone and the PTR record name in it, looked up in advance for many addresses at once
+ReverseLookup = Tuple[Optional[ReverseZone], Optional[str]]
 
-    zone = Zone.objects.find_for_dns_name(dns_name)
-    if zone:
-        logger.debug(f"Found zone {zone.name} for {dns_name}")
 
-        # Check the SOA, we don't want to write to a parent zone if it has delegated authority
-        soa = get_soa(zone.name)
-        if soa == zone.name:
-            record_type = 'A' if address.version == 4 else 'AAAA'
-            update = zone.server.create_update(zone.name)
-            update.delete(
-                dns_name,
-                record_type,
-                str(address)
-            )
-            response = dns.query.udp(update, zone.server.address, port=zone.server.server_port)
-            status_update(output, f'Deleting {dns_name} {record_type} {address}', response)
-            if status:
-                status.forward_rcode = response.rcode()
-        else:
-            logger.warning(f"Can't update zone {zone.name} {dns_name}, "
-                           f"it has delegated authority for {soa}")
-            if status:
-                status.forward_rcode = rcode.NOTAUTH
-    else:
-        logger.debug(f"No zone found for {dns_name}")
-        if status:
-            status.forward_rcode = RCODE_NO_ZONE
-
-
-def create_reverse(dns_name: str, address: ip.IPAddress, status: Optional[DNSStatus], output: List[str]):
+def plan_reverse(action: int, dns_name: str, address: ip.IPAddress, status: Optional[DNSStatus],
+                 lookup: Optional[ReverseLookup] = None) -> Optional[PendingRecord]:
     if status:
-        status.reverse_action = ACTION_CREATE
+        status.reverse_action = action
 
-    zone = ReverseZone.objects.find_for_address(address)
+    if lookup:
+        zone, record_name = lookup
+    else:
+        start = time.monotonic()
+        zone = reverse_zone_index.find(address)
+        record_name = zone.record_name(address) if zone else None
+        metrics.add_phase('zone_lookup', time.monotonic() - start, zone.server if zone else None)
     if zone:
-        record_name = zone.record_name(address)
         logger.debug(f"Found zone {zone.name} for {record_name}")
 
         # Check the SOA, we don't want to write to a parent zone if it has delegated authority
-        soa = get_soa(record_name)
+        with metrics.soa_timer(), metrics.phase('soa', zone.server):
+            soa = get_soa(record_name)
         if soa == zone.name:
-            update = zone.server.create_update(zone.name)
-            update.add(
-                record_name,
-                zone.ttl,
-                'ptr',
-                dns_name
+            if action == ACTION_CREATE:
+                operation = f'Adding {record_name} PTR {dns_name}'
+            else:
+                operation = f'Deleting {record_name} PTR {dns_name}'
+
+            return PendingRecord(
+                server=zone.server,
+                zone_name=zone.name,
+                action=action,
+                name=record_name,
+                ttl=zone.ttl,
+                rdtype='ptr',
+                rdata=dns_name,
+                status=status,
+                status_field='reverse_rcode',
+                operation=operation,
             )
-            response = dns.query.udp(update, zone.server.address, port=zone.server.server_port)
-            status_update(output, f'Adding {record_name} PTR {dns_name}', response)
-            if status:
-                status.reverse_rcode = response.rcode()
         else:
             logger.warning(f"Can't update zone {zone.name} for {record_name}, "
                            f"it has delegated authority for {soa}")
+            metrics.record_unsent(zone.server, zone.name, rcode.NOTAUTH)
             if status:
                 status.reverse_rcode = rcode.NOTAUTH
     else:
         logger.debug(f"No zone found for {address}")
+        metrics.record_unsent(None, '', RCODE_NO_ZONE)
         if status:
             status.reverse_rcode = RCODE_NO_ZONE
 
 
-def delete_reverse(dns_name: str, address: ip.IPAddress, status: Optional[DNSStatus], output: List[str]):
-    if status:
-        status.reverse_action = ACTION_DELETE
-
-    zone = ReverseZone.objects.find_for_address(address)
-    if zone:
-        record_name = zone.record_name(address)
-        logger.debug(f"Found zone {zone.name} for {record_name}")
-
-        # Check the SOA, we don't want to write to a parent zone if it has delegated authority
-        soa = get_soa(record_name)
-        if soa == zone.name:
-            update = zone.server.create_update(zone.name)
-            update.delete(
-                record_name,
-                'ptr',
-                dns_name
-            )
-            response = dns.query.udp(update, zone.server.address, port=zone.server.server_port)
-            status_update(output, f'Deleting {record_name} PTR {dns_name}', response)
-            if status:
-                status.reverse_rcode = response.rcode()
+def apply_response(record: PendingRecord, response, output: List[str]):
+    status_update(output, record.operation, response)
+    metrics.record_response(record.server, record.zone_name, response.rcode())
+    if record.status:
+        code = response.rcode()
+        setattr(record.status, record.status_field, code)
+
+        fingerprint = record.fingerprint
+        if record.action == ACTION_CREATE:
+            setattr(record.status, record.fingerprint_field, fingerprint if code == rcode.NOERROR else '')
+        elif getattr(record.status, record.fingerprint_field) == fingerprint:
+            # The record that was pushed last has been deleted, or is in an unknown state
+            setattr(record.status, record.fingerprint_field, '')
+
+
+def apply_responses(results: List[Tuple[PendingRecord, dns.message.Message]], output: List[str]):
+    for record, response in results:
+        apply_response(record, response, output)
+
+    # A delete removes the record for every status that has it, like another IP address with the same name and
+    # address, and also when it was sent without a status because the IP address is gone
+    deleted = {record.fingerprint for record, response in results if record.action != ACTION_CREATE}
+    if deleted:
+        status_writer.forget_fingerprints(deleted, [record.status for record, response in results if record.status])
+
+
+def is_unchanged(record: PendingRecord) -> bool:
+    """
+    Whether the record has already been added successfully, exactly like this, according to its status
+    """
+    status = record.status
+    return bool(status) and record.action == ACTION_CREATE \
+        and getattr(status, record.status_field) == rcode.NOERROR \
+        and getattr(status, record.fingerprint_field) == record.fingerprint
+
+
+def skip_unchanged(records: List[PendingRecord], output: List[str]) -> List[PendingRecord]:
+    changed = []
+    skipped = 0
+    for record in records:
+        if is_unchanged(record):
+            logger.debug(f"{record.operation} skipped, unchanged")
+            metrics.record_unchanged(record.server, record.zone_name)
+            skipped += 1
         else:
-            logger.warning(f"Can't update zone {zone.name} for {record_name}, "
-                           f"it has delegated authority for {soa}")
-            if status:
-                status.reverse_rcode = rcode.NOTAUTH
-    else:
-        logger.debug(f"No zone found for {address}")
-        if status:
-            status.reverse_rcode = RCODE_NO_ZONE
+            changed.append(record)
+
+    if skipped:
+        output.append(f"{skipped} unchanged records skipped")
+    return changed
+
+
+def park_records(records: List[PendingRecord], output: List[str]):
+    server = records[0].server
+    park(server, dns_send_records, pack_records(records))
+    metrics.record_parked(server, len(records))
+
+    for record in records:
+        message = f"{record.operation} parked, {server} is unavailable"
+        logger.warning(message)
+        output.append(message)
+        if record.status:
+            # No response yet
+            setattr(record.status, record.status_field, None)
+
+
+def send_records(records: Iterable[PendingRecord], output: List[str]):
+    """
+    Send the records in as few UPDATE messages as possible, concurrently where the order doesn't matter. Records
+    for servers with an open circuit breaker are parked until the server is available again.
+    """
+    allowed = {}
+    available = []
+    parked = {}
+    for record in records:
+        server = record.server
+        if server.pk not in allowed:
+            allowed[server.pk] = breaker.allow(server)
+
+        if allowed[server.pk]:
+            available.append(record)
+        else:
+            parked.setdefault(server.pk, []).append(record)
 
+    for server_records in parked.values():
+        park_records(server_records, output)
 
-@job
-def dns_create(dns_name: str, address: ip.IPAddress, forward=True, reverse=True, status: DNSStatus = None):
-    output = []
+    try:
+        results = dispatch(available)
+    except DispatchError as e:
+        apply_responses(e.results, output)
 
-    if forward:
-        create_forward(dns_name, address, status, output)
-    if reverse:
-        create_reverse(dns_name, address, status, output)
+        # The action of these records has been stored already, their previous response doesn't belong to it
+        answered = {id(record) for record, response in e.results}
+        for record in available:
+            if record.status and id(record) not in answered:
+                setattr(record.status, record.status_field, None)
+        raise e.error
 
-    if status:
-        try:
-            status.save()
-        except IntegrityError:
-            # Race condition when creating?
-            status.save(force_update=True)
-
-    return ', '.join(output)
+    apply_responses(results, output)
 
 
-@job
-def dns_delete(dns_name: str, address: ip.IPAddress, forward=True, reverse=True, status: DNSStatus = None):
+def send_and_save(records: List[PendingRecord], statuses: Iterable, force: bool = False) -> str:
     output = []
+    if not force and get_config('skip_unchanged'):
+        records = skip_unchanged(records, output)
+    try:
+        send_records(records, output)
+    finally:
+        # Written in bulk when the batch of the job ends, or directly when not running in a batch. Also when sending
+        # failed halfway, the results that did come in have been applied to the statuses.
+        for status in statuses:
+            status_writer.add(status)
 
-    if forward:
-        delete_forward(dns_name, address, status, output)
-    if reverse:
-        delete_reverse(dns_name, address, status, output)
+    return ', '.join(output)
 
-    if status:
-        try:
-            status.save()
-        except IntegrityError:
-            # Race condition when creating?
-            status.save(force_update=True)
 
-    return ', '.join(output)
+# An operation for dns_batch: (action, dns_name, address, forward, reverse, status)
+BatchOperation = Tuple[int, str, ip.IPAddress, bool, bool, Optional[DNSStatus]]
+
+
+def lookup_reverse(operations: List[BatchOperation]) -> Dict[ip.IPAddress, ReverseLookup]:
+    """
+    Find the reverse zones and PTR record names of all reverse operations at once
+    """
+    addresses = {address for action, dns_name, address, forward, reverse, status in operations if reverse}
+    if len(addresses) < 2:
+        return {}
+
+    start = time.monotonic()
+    lookups = reverse_zone_index.find_names(addresses)
+    metrics.add_phase('zone_lookup', time.monotonic() - start)
+    return lookups
+
+
+def plan_operations(operations: List[BatchOperation]) -> List[PendingRecord]:
+    lookups = lookup_reverse(operations)
+    records = []
+    for action, dns_name, address, forward, reverse, status in operations:
+        if forward:
+            records.append(plan_forward(action, dns_name, address, status))
+        if reverse:
+            records.append(plan_reverse(action, dns_name, address, status, lookups.get(address)))
+
+    return [record for record in records if record]
+
+
+def run_operations(operations: Iterable[BatchOperation], force: bool = False) -> str:
+    operations = list(operations)
+    statuses = {id(status): status for action, dns_name, address, forward, reverse, status in operations if status}
+    return send_and_save(plan_operations(operations), statuses.values(), force=force)
+
+
+# Jobs take their arguments in the compact form of payload.py: packed addresses and references to status objects
+@plugin_job()
+def dns_create(dns_name: str, address: bytes, forward=True, reverse=True, status: Optional[StatusRef] = None,
+               force=False):
+    with metrics.measure_job('dns_create') as timings, status_writer.batch():
+        operations = unpack_operations([(ACTION_CREATE, dns_name, address, forward, reverse, status)])
+        output = run_operations(operations, force=force)
+    return timings.result(output)
+
+
+@plugin_job()
+def dns_delete(dns_name: str, address: bytes, forward=True, reverse=True, status: Optional[StatusRef] = None):
+    with metrics.measure_job('dns_delete') as timings, status_writer.batch():
+        operations = unpack_operations([(ACTION_DELETE, dns_name, address, forward, reverse, status)])
+        output = run_operations(operations)
+    return timings.result(output)
+
+
+@plugin_job(PRIORITY_BULK)
+def dns_batch(operations: List[CompactOperation], force=False):
+    """
+    Apply many create and delete operations at once, packing the records for the same zone into shared messages and
+    sending the messages for different zones and servers concurrently
+    """
+    with metrics.measure_job('dns_batch') as timings, status_writer.batch():
+        output = run_operations(unpack_operations(operations), force=force)
+    return timings.result(output)
+
+
+@plugin_job(PRIORITY_BULK)
+def dns_send_records(records: List[CompactRecord]):
+    """
+    Send records that have already been planned, used for the work that was parked while a server was unavailable
+    """
+    with metrics.measure_job('dns_send_records') as timings, status_writer.batch():
+        records = unpack_records(records)
+        statuses = {id(record.status): record.status for record in records if record.status}
+
+        # Unchanged records have been skipped before they were parked
+        output = send_and_save(records, statuses.values(), force=True)
+    return timings.result(output)
+
+
+def batched(operations: Iterable[BatchOperation]) -> Iterable[List[BatchOperation]]:
+    """
+    Split a stream of operations into lists that fit in one dns_batch job
+    """
+    batch = []
+    for operation in operations:
+        batch.append(operation)
+        if len(batch) >= get_config('batch_size'):
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
@@ -0,0 +1,114 @@
+import hashlib
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import dns.update
+
+from .models import ACTION_CREATE, DNSStatus, ExtraDNSName, Server
+from .utils import get_config
+
+# RDATA sizes of the fixed-size record types we send
+RDATA_SIZES = {
+    'A': 4,
+    'AAAA': 16,
+}
+
+# Header, zone section fixed fields and an upper bound on the TSIG record without its key name
+MESSAGE_OVERHEAD = 12 + 4 + 128
+
+
+def name_wire_size(dns_name: str) -> int:
+    # Without compression a name takes one length byte per label plus the root label
+    return len(dns_name.rstrip('.')) + 2
+
+
+def record_fingerprint(server_pk: int, zone_name: str, name: str, ttl: int, rdtype: str, rdata: str) -> str:
+    """
+    A compact digest of everything that determines what a record looks like on its server
+    """
+    value = '\0'.join((str(server_pk), zone_name.lower(), name.lower(), str(ttl), rdtype.upper(), rdata.lower()))
+    return hashlib.blake2b(value.encode(), digest_size=8).hexdigest()
+
+
+class PendingRecord:
+    """
+    One resource record to add to or delete from a zone, and where to store the response code
+    """
+    __slots__ = ('server', 'zone_name', 'action', 'name', 'ttl', 'rdtype', 'rdata', 'status', 'status_field',
+                 'operation')
+
+    def __init__(self, server: Server, zone_name: str, action: int, name: str, ttl: int, rdtype: str, rdata: str,
+                 status: Optional[DNSStatus | ExtraDNSName], status_field: str, operation: str):
+        self.server = server
+        self.zone_name = zone_name
+        self.action = action
+        self.name = name
+        self.ttl = ttl
+        self.rdtype = rdtype
+        self.rdata = rdata
+        self.status = status
+        self.status_field = status_field
+        self.operation = operation
+
+    @property
+    def wire_size(self) -> int:
+        rdata_size = RDATA_SIZES.get(self.rdtype.upper()) or name_wire_size(self.rdata)
+        return name_wire_size(self.name) + 10 + rdata_size
+
+    @property
+    def fingerprint(self) -> str:
+        return record_fingerprint(self.server.pk, self.zone_name, self.name, self.ttl, self.rdtype, self.rdata)
+
+    @property
+    def fingerprint_field(self) -> str:
+        # forward_rcode goes with forward_fingerprint, reverse_rcode with reverse_fingerprint
+        return self.status_field.replace('_rcode', '_fingerprint')
+
+    def add_to(self, update: dns.update.Update):
+        if self.action == ACTION_CREATE:
+            update.add(self.name, self.ttl, self.rdtype, self.rdata)
+        else:
+            update.delete(self.name, self.rdtype, self.rdata)
+
+    def build_update(self) -> dns.update.Update:
+        update = self.server.create_update(self.zone_name)
+        self.add_to(update)
+        return update
+
+
+def pack_records(records: Iterable[PendingRecord]) -> Iterator[Tuple[dns.update.Update, List[PendingRecord], bool]]:
+    """
+    Pack records into as few UPDATE messages per zone as fit within the configured size budget. Records keep their
+    relative order. Yields each message with its records, and whether it is too big for UDP and needs TCP.
+    """
+    zones = {}
+    for record in records:
+        zones.setdefault((record.server.pk, record.zone_name), []).append(record)
+
+    max_size = get_config('update_max_size')
+    max_records = get_config('update_max_records')
+    udp_max_size = get_config('udp_max_size')
+
+    for zone_records in zones.values():
+        first = zone_records[0]
+        overhead = MESSAGE_OVERHEAD + name_wire_size(first.zone_name) + name_wire_size(first.server.tsig_key_name)
+
+        update = None
+        message_records = []
+        size = overhead
+        for record in zone_records:
+            record_size = record.wire_size
+            if message_records and (size + record_size > max_size or len(message_records) >= max_records):
+                yield update, message_records, size > udp_max_size
+                update = None
+                message_records = []
+                size = overhead
+
+            if update is None:
+                update = first.server.create_update(first.zone_name)
+
+            record.add_to(update)
+            message_records.append(record)
+            size += record_size
+
+        if message_records:
+            yield update, message_records, size > udp_max_size
@@ -0,0 +1,398 @@
+"""
+End-to-end throughput benchmark. Generates zones, reverse zones, IP addresses and extra names, points a server at an
+in-process stand-in for the DNS primary, and measures how fast changes travel from the signals through the
+background jobs to the wire. Meant for test instances, it writes to the database and runs the jobs itself.
+"""
+import base64
+import math
+import os
+import platform
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional
+
+import django_rq
+import dns.resolver
+import dns.tsig
+import dns.tsigkeyring
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.db import transaction
+from django.test import RequestFactory
+from netaddr import IPAddress as NetAddress, IPNetwork
+
+from ipam.models import IPAddress
+from .. import VERSION
+from ..coalesce import collector
+from ..lookup import reverse_zone_index, zone_index
+from ..models import ExtraDNSName, ReverseZone, Server, Zone
+from ..queues import PRIORITY_BULK, PRIORITY_INTERACTIVE, queue_name
+from ..resync import KIND_FORWARD, KIND_REVERSE, enqueue_resync
+from ..utils import delegation_cache
+from ..views import IPAddressDNSNameRecreateView
+from .standin import StandInServer, make_zone
+
+# Everything the benchmark creates can be recognised by this domain or description
+BENCH_DOMAIN = 'bench.netbox-ddns.test.'
+BENCH_DESCRIPTION = 'netbox_ddns benchmark'
+BENCH_KEY_NAME = 'benchmark.netbox-ddns.test.'
+
+IPV4_BASE = int(NetAddress('10.0.0.0'))
+IPV6_BASE = int(NetAddress('2001:db8::'))
+IPV6_PREFIX = IPNetwork('2001:db8::/48')
+
+# One in this many generated addresses is IPv6, one in EXTRA_RATIO addresses gets an extra name
+IPV6_RATIO = 5
+EXTRA_RATIO = 10
+
+FORWARD_ZONES = 16
+CREATE_BATCH_SIZE = 5000
+STORM_CLICKS = 10
+
+# Reverse zone sizes for comparing record_name with record_names
+PTR_PREFIXES = ('10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '2001:db8::/32', '2001:db8::/48', '2001:db8::/64')
+
+SCALES = {
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+}
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+@contextmanager
+def plugin_config(**overrides):
+    """
+    Temporarily change plugin settings in this process
+    """
+    config = settings.PLUGINS_CONFIG.setdefault('netbox_ddns', {})
+    saved = {name: config[name] for name in overrides if name in config}
+    config.update(overrides)
+    try:
+        yield
+    finally:
+        for name in overrides:
+            if name in saved:
+                config[name] = saved[name]
+            else:
+                config.pop(name, None)
+
+
+@contextmanager
+def resolver_for(standin: StandInServer):
+    """
+    Send the SOA lookups of get_soa to the stand-in
+    """
+    resolver = dns.resolver.Resolver(configure=False)
+    resolver.nameservers = [standin.host]
+    resolver.port = standin.port
+
+    saved = dns.resolver.default_resolver
+    dns.resolver.default_resolver = resolver
+    delegation_cache.flush()
+    try:
+        yield
+    finally:
+        dns.resolver.default_resolver = saved
+        delegation_cache.flush()
+
+
+class Dataset:
+    """
+    The synthetic data: forward zones under BENCH_DOMAIN, reverse zones for the used part of 10.0.0.0/8 and for
+    2001:db8::/48, and `scale` named IP addresses. Address indexes from `scale` up are left free for the scenarios.
+    """
+
+    def __init__(self, scale: int, operations: int):
+        self.scale = scale
+        self.operations = operations
+        self.secret = base64.b64encode(os.urandom(32)).decode()
+        self.keyring = dns.tsigkeyring.from_text({BENCH_KEY_NAME: self.secret})
+        self.server: Optional[Server] = None
+
+    @property
+    def capacity(self) -> int:
+        # The dataset, the addresses added by bulk_import and the ones renumber moves to
+        return self.scale + 2 * self.operations
+
+    @staticmethod
+    def forward_zone(index: int) -> str:
+        return f'z{index % FORWARD_ZONES}.{BENCH_DOMAIN}'
+
+    @classmethod
+    def dns_name(cls, index: int) -> str:
+        return f'host-{index}.{cls.forward_zone(index)}'
+
+    @staticmethod
+    def address(index: int) -> str:
+        if index % IPV6_RATIO == 0:
+            return f'{NetAddress(IPV6_BASE + index + 1)}/64'
+        return f'{NetAddress(IPV4_BASE + index + 1)}/16'
+
+    def reverse_zones(self) -> Dict[str, IPNetwork]:
+        zones = {}
+        for second in range(math.ceil((self.capacity + 2) / 65536)):
+            prefix = IPNetwork(f'10.{second}.0.0/16')
+            zones[f'{second}.10.in-addr.arpa.'] = prefix
+        zones['0.0.0.0.8.b.d.0.1.0.0.2.ip6.arpa.'] = IPV6_PREFIX
+        return zones
+
+    def zone_names(self) -> List[str]:
+        return [f'z{index}.{BENCH_DOMAIN}' for index in range(FORWARD_ZONES)] + list(self.reverse_zones())
+
+    def standin(self) -> StandInServer:
+        return StandInServer({name: make_zone(name) for name in self.zone_names()}, keyring=self.keyring)
+
+    def create(self, standin: StandInServer):
+        with collector.suspend():
+            self.server = Server.objects.create(
+                server=standin.host,
+                server_port=standin.port,
+                tsig_key_name=BENCH_KEY_NAME,
+                tsig_algorithm=str(dns.tsig.HMAC_SHA256),
+                tsig_key=self.secret,
+            )
+            Zone.objects.bulk_create([
+                Zone(name=f'z{index}.{BENCH_DOMAIN}', ttl=300, server=self.server)
+                for index in range(FORWARD_ZONES)
+            ])
+            ReverseZone.objects.bulk_create([
+                ReverseZone(prefix=prefix, name=name, ttl=300, server=self.server)
+                for name, prefix in self.reverse_zones().items()
+            ])
+
+            self._bulk_create(IPAddress, (
+                IPAddress(address=self.address(index), dns_name=self.dns_name(index).rstrip('.'),
+                          description=BENCH_DESCRIPTION)
+                for index in range(self.scale)
+            ))
+
+            ip_pks = IPAddress.objects.filter(description=BENCH_DESCRIPTION).order_by('pk').values_list('pk', flat=True)
+            self._bulk_create(ExtraDNSName, (
+                ExtraDNSName(ip_address_id=pk, name=f'extra-{pk}.{self.forward_zone(pk)}')
+                for pk in ip_pks[:self.scale // EXTRA_RATIO].iterator()
+            ))
+
+        # bulk_create doesn't send the signals that normally invalidate the indexes
+        zone_index.invalidate()
+        reverse_zone_index.invalidate()
+
+    @staticmethod
+    def _bulk_create(model, objects: Iterator):
+        batch = []
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) >= CREATE_BATCH_SIZE:
+                model.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            model.objects.bulk_create(batch)
+
+    @staticmethod
+    def remove():
+        with collector.suspend():
+            IPAddress.objects.filter(description=BENCH_DESCRIPTION).delete()
+            servers = Server.objects.filter(tsig_key_name=BENCH_KEY_NAME)
+            Zone.objects.filter(server__in=servers).delete()
+            ReverseZone.objects.filter(server__in=servers).delete()
+            servers.delete()
+
+
+# A scenario makes changes and returns the time each forward name was changed
+Scenario = Callable[[Dataset], Dict[str, float]]
+
+
+def bulk_import(dataset: Dataset) -> Dict[str, float]:
+    """
+    Create new IP addresses in one transaction, like a CSV import
+    """
+    changed = {}
+    with transaction.atomic():
+        for index in range(dataset.scale, dataset.scale + dataset.operations):
+            dns_name = dataset.dns_name(index)
+            IPAddress(address=dataset.address(index), dns_name=dns_name.rstrip('.'),
+                      description=BENCH_DESCRIPTION).save()
+            changed[dns_name] = time.monotonic()
+    return changed
+
+
+def renumber(dataset: Dataset) -> Dict[str, float]:
+    """
+    Move existing IPv4 addresses to new addresses in one transaction, keeping their names
+    """
+    ip_addresses = IPAddress.objects.filter(description=BENCH_DESCRIPTION, address__family=4) \
+        .order_by('pk')[:dataset.operations]
+
+    changed = {}
+    with transaction.atomic():
+        for offset, ip_address in enumerate(ip_addresses):
+            index = dataset.scale + dataset.operations + offset
+            ip_address.address = IPNetwork(f'{NetAddress(IPV4_BASE + index + 1)}/16')
+            ip_address.save()
+            changed[f'{ip_address.dns_name}.'] = time.monotonic()
+    return changed
+
+
+def resync(dataset: Dataset) -> Dict[str, float]:
+    """
+    Use the admin action to force an update of all records of all zones
+    """
+    start = time.monotonic()
+    for zone in Zone.objects.filter(server=dataset.server):
+        enqueue_resync(KIND_FORWARD, zone.pk, force=True)
+    for zone in ReverseZone.objects.filter(server=dataset.server):
+        enqueue_resync(KIND_REVERSE, zone.pk, force=True)
+
+    names = IPAddress.objects.filter(description=BENCH_DESCRIPTION).values_list('dns_name', flat=True)
+    return {f'{dns_name}.': start for dns_name in names.iterator()}
+
+
+def recreate_storm(dataset: Dataset) -> Dict[str, float]:
+    """
+    Click the recreate button of the same IP addresses over and over, without force, so only the first click sends
+    records and the others are skipped as unchanged
+    """
+    ip_addresses = list(IPAddress.objects.filter(description=BENCH_DESCRIPTION)
+                        .order_by('pk')[:max(1, dataset.operations // STORM_CLICKS)])
+
+    view = IPAddressDNSNameRecreateView()
+    factory = RequestFactory()
+    changed = {}
+    for _ in range(STORM_CLICKS):
+        for ip_address in ip_addresses:
+            request = factory.post(f'/plugins/ddns/ip-addresses/{ip_address.pk}/recreate/')
+            request._messages = CookieStorage(request)
+            changed.setdefault(f'{ip_address.dns_name}.', time.monotonic())
+            view.post(request, ipaddress_pk=ip_address.pk)
+    return changed
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    'bulk_import': bulk_import,
+    'renumber': renumber,
+    'resync': resync,
+    'recreate_storm': recreate_storm,
+}
+
+
+def run_worker():
+    """
+    Run all queued jobs in this process, so the stand-in and the jobs share one clock
+    """
+    names = dict.fromkeys((queue_name(PRIORITY_INTERACTIVE), 'default', queue_name(PRIORITY_BULK)))
+    worker = django_rq.get_worker(*names, worker_class='rq.worker.SimpleWorker')
+    worker.work(burst=True, logging_level='WARNING')
+
+
+def measure(dataset: Dataset, standin: StandInServer, scenario: Scenario) -> dict:
+    first_update = len(standin.updates)
+    first_message = standin.messages
+
+    start = time.monotonic()
+    changed = scenario(dataset)
+    run_worker()
+    seconds = time.monotonic() - start
+
+    updates = standin.updates[first_update:]
+    arrived = {}
+    for arrival, name, deleting, _rdtype in updates:
+        if deleting is None and name in changed:
+            arrived.setdefault(name, arrival)
+
+    latencies = [arrival - changed[name] for name, arrival in arrived.items()]
+    return {
+        'changes': len(changed),
+        'records': len(updates),
+        'messages': standin.messages - first_message,
+        'seconds': round(seconds, 3),
+        'updates_per_second': round(len(updates) / seconds, 1) if seconds else None,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p99': percentile(latencies, 0.99),
+        'latency_max': max(latencies) if latencies else None,
+        'missing': len(changed) - len(arrived),
+    }
+
+
+def ptr_names(count: int) -> dict:
+    """
+    Compare generating PTR record names one at a time with record_name and in bulk with record_names, for unsaved
+    reverse zones of common sizes. Doesn't touch the database.
+    """
+    results = {
+        'version': VERSION,
+        'python': platform.python_version(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'count': count,
+        'prefixes': {},
+    }
+
+    for prefix in map(IPNetwork, PTR_PREFIXES):
+        zone = ReverseZone(prefix=prefix, name='')
+        zone.clean()
+
+        values = [prefix.first + random.randrange(prefix.size) for _ in range(count)]
+        addresses = [NetAddress(value, prefix.version) for value in values]
+
+        start = time.perf_counter()
+        one_by_one = [zone.record_name(address) for address in addresses]
+        single_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bulk = zone.record_names(values)
+        bulk_seconds = time.perf_counter() - start
+
+        if bulk != one_by_one:
+            raise AssertionError(f"record_names differs from record_name in {zone.name}")
+
+        results['prefixes'][str(prefix)] = {
+            'record_name_seconds': round(single_seconds, 4),
+            'record_names_seconds': round(bulk_seconds, 4),
+            'speedup': round(single_seconds / bulk_seconds, 1) if bulk_seconds else None,
+        }
+
+    return results
+
+
+def run(scale: int, operations: int, scenarios: List[str], rate_limit: bool = False, keep: bool = False,
+        log: Callable[[str], None] = lambda message: None) -> dict:
+    """
+    Run the scenarios in order against a fresh dataset and return the results as a JSON serialisable dict
+    """
+    dataset = Dataset(scale, operations)
+    Dataset.remove()
+
+    results = {
+        'version': VERSION,
+        'python': platform.python_version(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'scale': scale,
+        'operations': operations,
+        'rate_limit': rate_limit,
+        'scenarios': {},
+    }
+
+    with dataset.standin() as standin, resolver_for(standin), \
+            plugin_config(coalesce_window=0, throttle_bulk_depth=0, rate_limit=rate_limit):
+        log(f"Generating {scale} IP addresses")
+        start = time.monotonic()
+        dataset.create(standin)
+        results['generate_seconds'] = round(time.monotonic() - start, 3)
+
+        try:
+            for name in scenarios:
+                log(f"Running {name}")
+                results['scenarios'][name] = measure(dataset, standin, SCENARIOS[name])
+        finally:
+            if not keep:
+                log("Removing the generated data")
+                Dataset.remove()
+
+    return results
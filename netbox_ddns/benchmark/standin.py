@@ -0,0 +1,279 @@
+"""
+A small in-process authoritative DNS server built on dnspython. It answers queries, serves AXFR and applies
+RFC 2136 updates, so the update and reconciliation code can be exercised without a real primary like BIND.
+"""
+import logging
+import socketserver
+import struct
+import threading
+import time
+from typing import Dict, List, Optional
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+import dns.tsig
+import dns.zone
+
+logger = logging.getLogger('netbox_ddns')
+
+# Number of records per message in an AXFR response
+AXFR_RECORDS_PER_MESSAGE = 500
+
+
+def make_zone(origin: str, ttl: int = 3600) -> dns.zone.Zone:
+    """
+    Create an empty zone with just a SOA and NS record
+    """
+    origin = dns.name.from_text(origin)
+    zone = dns.zone.Zone(origin, relativize=False)
+    soa = zone.find_rdataset(origin, dns.rdatatype.SOA, create=True)
+    soa.add(dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.SOA,
+                                f'ns.{origin} hostmaster.{origin} 1 3600 600 86400 {ttl}'), ttl)
+    ns = zone.find_rdataset(origin, dns.rdatatype.NS, create=True)
+    ns.add(dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.NS, f'ns.{origin}'), ttl)
+    return zone
+
+
+class StandInServer:
+    """
+    Serves the given zones on 127.0.0.1 over UDP and TCP. When a keyring is given, updates and transfers must be
+    signed with one of its keys. Each applied update is recorded in `updates` with its arrival time.
+    """
+
+    def __init__(self, zones: Dict[str, dns.zone.Zone], keyring: Optional[dict] = None, host: str = '127.0.0.1',
+                 port: int = 0, delay: float = 0.0):
+        self.zones = {dns.name.from_text(name): zone for name, zone in zones.items()}
+        self.keyring = keyring
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.updates: List[tuple] = []
+        self.messages = 0
+
+        server = self
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                for wire in server.handle_wire(data):
+                    sock.sendto(wire, self.client_address)
+
+        class TCPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    header = self._read(2)
+                    if not header:
+                        return
+                    length, = struct.unpack('!H', header)
+                    data = self._read(length)
+                    if data is None:
+                        return
+                    for wire in server.handle_wire(data, tcp=True):
+                        self.request.sendall(struct.pack('!H', len(wire)) + wire)
+
+            def _read(self, length):
+                data = b''
+                while len(data) < length:
+                    chunk = self.request.recv(length - len(data))
+                    if not chunk:
+                        return None
+                    data += chunk
+                return data
+
+        class UDPServer(socketserver.ThreadingUDPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        class TCPServer(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.tcp_server = TCPServer((host, port), TCPHandler)
+        self.host, self.port = self.tcp_server.server_address[:2]
+        self.udp_server = UDPServer((host, self.port), UDPHandler)
+        self.threads = []
+
+    def start(self) -> 'StandInServer':
+        for server in (self.tcp_server, self.udp_server):
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in (self.tcp_server, self.udp_server):
+            server.shutdown()
+            server.server_close()
+
+    def __enter__(self) -> 'StandInServer':
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def find_zone(self, name: dns.name.Name) -> Optional[dns.zone.Zone]:
+        best = None
+        for origin, zone in self.zones.items():
+            if name.is_subdomain(origin) and (best is None or len(origin) > len(best.origin)):
+                best = zone
+        return best
+
+    def handle_wire(self, data: bytes, tcp: bool = False) -> List[bytes]:
+        try:
+            query = dns.message.from_wire(data, keyring=self.keyring)
+        except (dns.tsig.BadSignature, dns.tsig.PeerError, dns.message.UnknownTSIGKey):
+            logger.warning("Stand-in received a message with a bad TSIG signature")
+            return []
+        except dns.exception.DNSException:
+            return []
+
+        if self.delay:
+            time.sleep(self.delay)
+
+        with self.lock:
+            self.messages += 1
+            if query.opcode() == dns.opcode.UPDATE:
+                response = self.handle_update(query)
+            elif query.question and query.question[0].rdtype == dns.rdatatype.AXFR:
+                if not tcp:
+                    response = dns.message.make_response(query)
+                    response.set_rcode(dns.rcode.REFUSED)
+                else:
+                    return self.handle_axfr(query)
+            else:
+                response = self.handle_query(query)
+
+        return [response.to_wire()]
+
+    def _signed(self, query: dns.message.Message) -> bool:
+        return self.keyring is None or query.had_tsig
+
+    def handle_query(self, query: dns.message.Message) -> dns.message.Message:
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        question = query.question[0]
+        zone = self.find_zone(question.name)
+        if zone is None:
+            response.set_rcode(dns.rcode.REFUSED)
+            return response
+
+        node = zone.get_node(question.name)
+        soa = zone.find_rrset(zone.origin, dns.rdatatype.SOA)
+        if node is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            response.authority.append(soa)
+            return response
+
+        rdataset = node.get_rdataset(question.rdclass, question.rdtype)
+        if rdataset:
+            rrset = dns.rrset.RRset(question.name, rdataset.rdclass, rdataset.rdtype)
+            rrset.update(rdataset)
+            response.answer.append(rrset)
+        else:
+            response.authority.append(soa)
+        return response
+
+    def handle_axfr(self, query: dns.message.Message) -> List[bytes]:
+        zone = self.zones.get(query.question[0].name)
+        if zone is None or not self._signed(query):
+            response = dns.message.make_response(query)
+            response.set_rcode(dns.rcode.NOTAUTH if zone is None else dns.rcode.REFUSED)
+            return [response.to_wire()]
+
+        soa = zone.find_rrset(zone.origin, dns.rdatatype.SOA)
+        rrsets = [soa]
+        for name, node in zone.nodes.items():
+            for rdataset in node.rdatasets:
+                if rdataset.rdtype == dns.rdatatype.SOA:
+                    continue
+                rrset = dns.rrset.RRset(name, rdataset.rdclass, rdataset.rdtype)
+                rrset.update(rdataset)
+                rrsets.append(rrset)
+        rrsets.append(soa)
+
+        wires = []
+        tsig_ctx = None
+        for start in range(0, len(rrsets), AXFR_RECORDS_PER_MESSAGE):
+            response = dns.message.make_response(query)
+            response.flags |= dns.flags.AA
+            response.answer = rrsets[start:start + AXFR_RECORDS_PER_MESSAGE]
+            wires.append(response.to_wire(multi=True, tsig_ctx=tsig_ctx))
+            tsig_ctx = getattr(response, 'tsig_ctx', None)
+        return wires
+
+    def handle_update(self, update: dns.message.Message) -> dns.message.Message:
+        response = dns.message.make_response(update)
+        zone = self.zones.get(update.question[0].name) if update.question else None
+        if zone is None:
+            response.set_rcode(dns.rcode.NOTAUTH)
+            return response
+        if not self._signed(update):
+            response.set_rcode(dns.rcode.REFUSED)
+            return response
+
+        # Prerequisites, RFC 2136 section 3.2. dnspython reports the ANY and NONE classes in `deleting`.
+        for rrset in update.answer:
+            node = zone.get_node(rrset.name)
+            if rrset.deleting == dns.rdataclass.ANY:
+                exists = node is not None and (rrset.rdtype == dns.rdatatype.ANY or
+                                               node.get_rdataset(dns.rdataclass.IN, rrset.rdtype) is not None)
+                if not exists:
+                    response.set_rcode(dns.rcode.NXDOMAIN if rrset.rdtype == dns.rdatatype.ANY
+                                       else dns.rcode.NXRRSET)
+                    return response
+            elif rrset.deleting == dns.rdataclass.NONE:
+                exists = node is not None and (rrset.rdtype == dns.rdatatype.ANY or
+                                               node.get_rdataset(dns.rdataclass.IN, rrset.rdtype) is not None)
+                if exists:
+                    response.set_rcode(dns.rcode.YXDOMAIN if rrset.rdtype == dns.rdatatype.ANY
+                                       else dns.rcode.YXRRSET)
+                    return response
+
+        changed = False
+        now = time.monotonic()
+        for rrset in update.update:
+            if not rrset.name.is_subdomain(zone.origin):
+                response.set_rcode(dns.rcode.NOTZONE)
+                return response
+
+            if rrset.deleting is None:
+                rdataset = zone.find_rdataset(rrset.name, rrset.rdtype, create=True)
+                before = len(rdataset)
+                rdataset.update_ttl(rrset.ttl)
+                for rdata in rrset:
+                    rdataset.add(rdata, rrset.ttl)
+                changed |= len(rdataset) != before
+            elif rrset.deleting == dns.rdataclass.NONE:
+                rdataset = zone.get_rdataset(rrset.name, rrset.rdtype)
+                if rdataset:
+                    for rdata in rrset:
+                        if rdata in rdataset:
+                            rdataset.remove(rdata)
+                            changed = True
+                    if not rdataset:
+                        zone.delete_rdataset(rrset.name, rrset.rdtype)
+            elif rrset.deleting == dns.rdataclass.ANY:
+                if rrset.rdtype == dns.rdatatype.ANY:
+                    if rrset.name != zone.origin and zone.get_node(rrset.name):
+                        zone.delete_node(rrset.name)
+                        changed = True
+                elif zone.get_rdataset(rrset.name, rrset.rdtype):
+                    zone.delete_rdataset(rrset.name, rrset.rdtype)
+                    changed = True
+
+            self.updates.append((now, rrset.name.to_text(), rrset.deleting, rrset.rdtype))
+
+        if changed:
+            soa = zone.find_rdataset(zone.origin, dns.rdatatype.SOA)
+            old = soa[0]
+            soa.remove(old)
+            soa.add(old.replace(serial=old.serial + 1))
+
+        return response
@@ -0,0 +1,232 @@
+import logging
+import time
+from datetime import timedelta
+from typing import Optional
+
+import django_rq
+import dns.exception
+import dns.message
+import dns.query
+from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from .models import ReverseZone, Server, Zone
+from .queues import PRIORITY_BULK, PRIORITY_INTERACTIVE, get_queue, plugin_job
+from .utils import get_config
+
+logger = logging.getLogger('netbox_ddns')
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+# Errors that mean the server didn't answer at all, any response means it's up
+UNAVAILABLE_ERRORS = (dns.exception.Timeout, OSError, EOFError)
+
+# Failure counts of servers are forgotten after this many seconds without failures. An open breaker stays open until
+# a probe gets an answer.
+STATE_EXPIRY = 86400
+
+# Seconds on top of breaker_reset_timeout after which a probe that should have run is considered lost
+PROBE_GRACE = 60
+
+
+def parked_queue_name(server_pk: int) -> str:
+    return f'netbox_ddns_parked_{server_pk}'
+
+
+def parked_queue(server_pk: int, connection=None) -> Queue:
+    return Queue(parked_queue_name(server_pk), connection=connection or django_rq.get_connection())
+
+
+class CircuitBreaker:
+    """
+    Stops sending to a DDNS server after breaker_threshold consecutive updates got no response. While the breaker is
+    open, work for that server is parked in a holding queue that no worker listens to, and a probe checks every
+    breaker_reset_timeout seconds whether the server answers again. When it does, the breaker closes and the parked
+    jobs are moved back to the normal queue. The state is shared by all workers through Redis, and each process
+    remembers which servers it knows to be closed so successful updates don't need to touch Redis.
+    """
+
+    def __init__(self):
+        self._closed = set()
+
+    @staticmethod
+    def _key(server_pk: int, name: str) -> str:
+        return f'netbox_ddns:breaker:{server_pk}:{name}'
+
+    @staticmethod
+    def _connection():
+        return django_rq.get_connection()
+
+    def state(self, server: Server) -> str:
+        state = self._connection().get(self._key(server.pk, 'state'))
+        return state.decode() if state else STATE_CLOSED
+
+    def allow(self, server: Server) -> bool:
+        """
+        Whether updates may be sent to the server
+        """
+        if not get_config('breaker_threshold') or server.pk is None:
+            return True
+
+        state, probe = self._connection().mget(self._key(server.pk, 'state'), self._key(server.pk, 'probe'))
+        if not state:
+            return True
+
+        self._closed.discard(server.pk)
+        if not probe and schedule_probe(server.pk, only_if_missing=True):
+            logger.warning(f"The probe for DDNS server {server} got lost, scheduled a new one")
+        return False
+
+    def success(self, server: Server):
+        if not get_config('breaker_threshold') or server.pk is None or server.pk in self._closed:
+            return
+
+        connection = self._connection()
+        pipeline = connection.pipeline()
+        pipeline.delete(self._key(server.pk, 'failures'))
+        pipeline.delete(self._key(server.pk, 'state'))
+        pipeline.delete(self._key(server.pk, 'probe'))
+        pipeline.llen(parked_queue(server.pk, connection).key)
+        _, was_open, _, parked = pipeline.execute()
+        self._closed.add(server.pk)
+
+        if was_open:
+            logger.info(f"DDNS server {server} is answering again, closing the circuit breaker")
+        if parked:
+            # Also when another process closed the breaker without draining, for example because it crashed
+            drain_parked(server.pk)
+
+    def failure(self, server: Server):
+        threshold = get_config('breaker_threshold')
+        if not threshold or server.pk is None:
+            return
+
+        self._closed.discard(server.pk)
+        connection = self._connection()
+        pipeline = connection.pipeline()
+        pipeline.incr(self._key(server.pk, 'failures'))
+        pipeline.expire(self._key(server.pk, 'failures'), STATE_EXPIRY)
+        failures, _ = pipeline.execute()
+        if failures < threshold:
+            return
+
+        # Only the worker that opens the breaker schedules the probe
+        if connection.set(self._key(server.pk, 'state'), STATE_OPEN, nx=True):
+            logger.error(f"DDNS server {server} didn't respond {failures} times in a row, opening the circuit breaker")
+            schedule_probe(server.pk)
+
+    def reopen(self, server: Server):
+        self._closed.discard(server.pk)
+        self._connection().set(self._key(server.pk, 'state'), STATE_OPEN)
+        schedule_probe(server.pk)
+
+    def half_open(self, server: Server) -> bool:
+        """
+        Mark the breaker as being probed, returns False when it isn't open (anymore)
+        """
+        self._closed.discard(server.pk)
+        return bool(self._connection().set(self._key(server.pk, 'state'), STATE_HALF_OPEN, xx=True))
+
+    def forget(self, server_pk: int):
+        """
+        Remove the state of a server that has been deleted
+        """
+        self._closed.discard(server_pk)
+        self._connection().delete(*(self._key(server_pk, name) for name in ('failures', 'state', 'probe')))
+
+
+breaker = CircuitBreaker()
+
+
+def park(server: Server, func, *args) -> Job:
+    """
+    Put a job in the holding queue of a server that is unavailable
+    """
+    parked_job = parked_queue(server.pk).enqueue(func, *args, result_ttl=get_config('result_ttl'))
+
+    # The breaker may have closed while parking, don't leave the job behind
+    if breaker.allow(server):
+        drain_parked(server.pk)
+
+    return parked_job
+
+
+def drain_parked(server_pk: int) -> int:
+    """
+    Move the parked jobs of a server back to the bulk queue, there may be many of them
+    """
+    connection = django_rq.get_connection()
+    parked = parked_queue(server_pk, connection)
+    queue = get_queue(PRIORITY_BULK)
+
+    count = 0
+    while True:
+        job_id = parked.pop_job_id()
+        if not job_id:
+            break
+
+        try:
+            parked_job = Job.fetch(job_id, connection=connection)
+        except NoSuchJobError:
+            continue
+
+        queue.enqueue_job(parked_job)
+        count += 1
+
+    if count:
+        logger.info(f"Moved {count} parked jobs for DDNS server {server_pk} back to the queue")
+    return count
+
+
+def schedule_probe(server_pk: int, only_if_missing: bool = False) -> bool:
+    """
+    Probe the server after breaker_reset_timeout seconds. Returns False when only_if_missing is set and a probe is
+    already scheduled.
+    """
+    timeout = get_config('breaker_reset_timeout')
+    if not django_rq.get_connection().set(CircuitBreaker._key(server_pk, 'probe'), 1, ex=timeout + PROBE_GRACE,
+                                          nx=only_if_missing):
+        return False
+
+    get_queue(PRIORITY_INTERACTIVE).enqueue_in(timedelta(seconds=timeout), dns_probe_server, server_pk,
+                                               result_ttl=get_config('result_ttl'))
+    return True
+
+
+def _probe_name(server: Server) -> str:
+    zone: Optional[Zone] = Zone.objects.filter(server=server).first()
+    if zone:
+        return zone.name
+    reverse_zone: Optional[ReverseZone] = ReverseZone.objects.filter(server=server).first()
+    if reverse_zone:
+        return reverse_zone.name
+    return '.'
+
+
+@plugin_job()
+def dns_probe_server(server_pk: int):
+    """
+    Check whether a server with an open circuit breaker answers again, any response counts
+    """
+    server = Server.objects.filter(pk=server_pk).first()
+    if not server:
+        breaker.forget(server_pk)
+        drain_parked(server_pk)
+        return f'Server {server_pk} no longer exists'
+
+    if not breaker.half_open(server):
+        return f'Circuit breaker for {server} is closed'
+
+    query = dns.message.make_query(_probe_name(server), 'SOA')
+    start = time.monotonic()
+    try:
+        dns.query.udp(query, server.address, port=server.server_port, timeout=get_config('update_timeout'))
+    except UNAVAILABLE_ERRORS as e:
+        breaker.reopen(server)
+        return f'{server} is still unavailable: {e}'
+
+    breaker.success(server)
+    return f'{server} answered in {time.monotonic() - start:.3f}s'
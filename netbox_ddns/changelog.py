@@ -0,0 +1,179 @@
+import logging
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+import django_rq
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from netaddr import IPNetwork
+
+from ipam.models import IPAddress
+from .background_tasks import run_operations
+from .coalesce import KIND_EXTRA, KIND_IPADDRESS, Change, ChangeContext
+from .metrics import metrics
+from .models import ExtraDNSName, SyncWatermark
+from .queues import PRIORITY_BULK, plugin_job
+from .resync import chunks
+from .utils import get_config, normalize_fqdn
+from .writeback import status_writer
+
+try:
+    # NetBox >= 4.1
+    from core.models import ObjectChange
+except ImportError:
+    from extras.models import ObjectChange
+
+logger = logging.getLogger('netbox_ddns')
+
+WATERMARK_NAME = 'changelog'
+LOCK_KEY = 'netbox_ddns:changelog:lock'
+
+
+def _ipaddress_state(data: Optional[dict]) -> dict:
+    if not data:
+        return {}
+
+    address = data.get('address')
+    return {
+        'address': str(IPNetwork(address).ip) if address else None,
+        'dns_name': normalize_fqdn(data.get('dns_name')),
+    }
+
+
+def _extra_state(data: Optional[dict], addresses: Dict[int, str]) -> dict:
+    if not data:
+        return {}
+
+    return {
+        'ip_address': data.get('ip_address'),
+        'address': addresses.get(data.get('ip_address')),
+        'name': normalize_fqdn(data.get('name')),
+    }
+
+
+def fold(rows: List, ipaddress_type_id: int) -> List[Change]:
+    """
+    Turn change log entries into one change per object, from its state before the first entry to its state after
+    the last one
+    """
+    states: Dict[Tuple[str, int], list] = {}
+    for row in rows:
+        kind = KIND_IPADDRESS if row.changed_object_type_id == ipaddress_type_id else KIND_EXTRA
+        key = (kind, row.changed_object_id)
+        if key not in states:
+            states[key] = [row.prechange_data, None]
+        states[key][1] = None if row.action == 'delete' else row.postchange_data
+
+    # Extra names are logged with the primary key of their IP address, use its address from before these changes
+    # when the IP address itself changed too, and its current address otherwise
+    ip_pks = {(old or new or {}).get('ip_address') for (kind, pk), (old, new) in states.items() if kind == KIND_EXTRA}
+    old_addresses = {pk: _ipaddress_state(old).get('address') for (kind, pk), (old, new) in states.items()
+                     if kind == KIND_IPADDRESS and old}
+    current_addresses = {pk: str(address.ip) for pk, address in
+                         IPAddress.objects.filter(pk__in=ip_pks).values_list('pk', 'address')}
+
+    # An IP address that is deleted with its extra names is gone when the changes are applied, remember its name
+    old_dns_names = {pk: _ipaddress_state(old).get('dns_name') for (kind, pk), (old, new) in states.items()
+                     if kind == KIND_IPADDRESS and old}
+
+    changes = []
+    for (kind, pk), (old, new) in states.items():
+        if kind == KIND_IPADDRESS:
+            changes.append((kind, pk, _ipaddress_state(old), _ipaddress_state(new) if new is not None else None))
+        else:
+            old_state = _extra_state(old, {**current_addresses, **old_addresses})
+            if new is None and old_state.get('ip_address') in old_dns_names:
+                old_state['main_dns_name'] = old_dns_names[old_state['ip_address']]
+            changes.append((
+                kind,
+                pk,
+                old_state,
+                _extra_state(new, {**old_addresses, **current_addresses}) if new is not None else None,
+            ))
+
+    return changes
+
+
+def incremental_sync(dry_run: bool = False, max_chunks: Optional[int] = None) -> Tuple[str, bool]:
+    """
+    Apply the changes to IP addresses and extra DNS names that were logged after the watermark, in chunks, moving
+    the watermark forward after each chunk and stopping after max_chunks chunks. The first run only sets the
+    watermark to the latest change. Overlapping runs are skipped. Returns a summary, and whether it stopped early.
+    """
+    lock = django_rq.get_connection().lock(LOCK_KEY, timeout=3600)
+    if not lock.acquire(blocking=False):
+        return 'Already running', False
+
+    try:
+        return _incremental_sync(dry_run, max_chunks)
+    finally:
+        lock.release()
+
+
+def _incremental_sync(dry_run: bool, max_chunks: Optional[int]) -> Tuple[str, bool]:
+    # Change log entries get their primary key when they are written, but only become visible when their transaction
+    # commits. Leave the most recent ones for the next run, so an entry of a transaction that is still running can't
+    # end up below the watermark.
+    entries = ObjectChange.objects.filter(time__lt=timezone.now() - timedelta(seconds=get_config('changelog_delay')))
+
+    latest = entries.order_by('-pk').values_list('pk', flat=True).first() or 0
+    watermark, created = SyncWatermark.objects.get_or_create(name=WATERMARK_NAME,
+                                                             defaults={'last_change_id': latest})
+    if created:
+        logger.info(f"Started following the change log at change {latest}")
+        return f'Following the change log from change {latest}', False
+
+    types = ContentType.objects.get_for_models(IPAddress, ExtraDNSName)
+    entries = entries.filter(changed_object_type__in=types.values()).only(
+        'pk', 'changed_object_type_id', 'changed_object_id', 'action', 'prechange_data', 'postchange_data',
+    )
+
+    entry_count = 0
+    operation_count = 0
+    chunk_count = 0
+    stopped = False
+    with status_writer.batch():
+        for rows in chunks(entries, after=watermark.last_change_id):
+            changes = fold(rows, types[IPAddress].pk)
+
+            # A dry run doesn't create missing status objects
+            operations = ChangeContext(changes, create_statuses=not dry_run).operations(changes)
+            entry_count += len(rows)
+            operation_count += len(operations)
+
+            # A dry run doesn't move the watermark, so it always reads everything
+            if dry_run:
+                continue
+
+            if operations:
+                run_operations(operations)
+
+            # Results of this chunk must be saved before moving past it
+            status_writer.flush()
+            SyncWatermark.objects.filter(pk=watermark.pk).update(last_change_id=rows[-1].pk,
+                                                                 last_update=timezone.now())
+
+            chunk_count += 1
+            if max_chunks and chunk_count >= max_chunks:
+                stopped = True
+                break
+
+    verb = 'would send' if dry_run else 'sent'
+    return f'{entry_count} change log entries since change {watermark.last_change_id}, ' \
+           f'{verb} {operation_count} updates', stopped
+
+
+@plugin_job(PRIORITY_BULK)
+def dns_incremental_sync(dry_run: bool = False):
+    """
+    Catch up with the change log one chunk at a time, queueing a job for the next chunk at the back of the bulk queue
+    so interactive jobs that were queued in the meantime go first. Runs can be scheduled as often as needed,
+    overlapping runs are skipped.
+    """
+    with metrics.measure_job('dns_incremental_sync') as timings:
+        output, stopped = incremental_sync(dry_run=dry_run, max_chunks=1)
+
+    if stopped:
+        # The lock has been released, so the next job can start right away
+        dns_incremental_sync.delay(dry_run)
+    return timings.result(output)
@@ -0,0 +1,365 @@
+import json
+import logging
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import django_rq
+from django.db import transaction
+from netaddr import IPAddress as NetAddress
+
+from ipam.models import IPAddress
+from .background_tasks import BatchOperation, batched, run_operations
+from .lookup import zone_index
+from .metrics import metrics
+from .models import ACTION_CREATE, ACTION_DELETE, DNSStatus, ExtraDNSName
+from .queues import PRIORITY_BULK, PRIORITY_INTERACTIVE, enqueue_bulk, get_queue, plugin_job
+from .utils import get_config, normalize_fqdn
+from .writeback import status_writer
+
+logger = logging.getLogger('netbox_ddns')
+
+KIND_IPADDRESS = 'ip'
+KIND_EXTRA = 'extra'
+
+# A change of an object: (kind, pk, old state, new state or None when deleted)
+Change = Tuple[str, int, dict, Optional[dict]]
+
+# Pending changes are dropped if they haven't been applied after this many seconds
+PENDING_EXPIRY = 86400
+
+# Seconds after which the lock on the changes of an object is released, in case the job holding it died
+LOCK_TIMEOUT = 300
+
+
+def _pending_key(kind: str, pk: int) -> str:
+    return f'netbox_ddns:pending:{kind}:{pk}'
+
+
+def _lock_key(kind: str, pk: int) -> str:
+    return _pending_key(kind, pk) + ':lock'
+
+
+def _store_pending(pipeline, kind: str, pk: int, old: dict, new: Optional[dict]):
+    key = _pending_key(kind, pk)
+    pipeline.hsetnx(key, 'old', json.dumps(old))
+    pipeline.hset(key, 'new', json.dumps(new))
+    pipeline.expire(key, PENDING_EXPIRY)
+
+
+def _schedule_pending(kind: str, pk: int, window: float = 0):
+    if window:
+        get_queue(PRIORITY_INTERACTIVE).enqueue_in(timedelta(seconds=window), dns_apply_pending, kind, pk,
+                                                   result_ttl=get_config('result_ttl'))
+    else:
+        dns_apply_pending.delay(kind, pk)
+
+
+def record_change(kind: str, pk: int, old: dict, new: Optional[dict]):
+    """
+    Remember the desired state of an object and schedule a job to apply it. When a change for the same object is
+    already pending, the original old state is kept, only the new state is replaced and no extra job is scheduled.
+    A new state of None means the object has been deleted.
+    """
+    key = _pending_key(kind, pk)
+    connection = django_rq.get_connection()
+
+    pipeline = connection.pipeline()
+    _store_pending(pipeline, kind, pk, old, new)
+    pipeline.hsetnx(key, 'scheduled', 1)
+    *_, newly_scheduled = pipeline.execute()
+
+    if not newly_scheduled:
+        logger.debug(f"Coalesced change of {kind} {pk} with a pending one")
+        return
+
+    _schedule_pending(kind, pk, get_config('coalesce_window'))
+
+
+def _parse_pending(data: dict):
+    if not data or b'old' not in data or b'new' not in data:
+        return None, None
+
+    return json.loads(data[b'old']), json.loads(data[b'new'])
+
+
+def _pop_pending(kind: str, pk: int):
+    key = _pending_key(kind, pk)
+    connection = django_rq.get_connection()
+
+    pipeline = connection.pipeline()
+    pipeline.hgetall(key)
+    pipeline.delete(key)
+    data, _ = pipeline.execute()
+    return _parse_pending(data)
+
+
+def _pop_many(objects: List[Tuple[str, int]]) -> List[Change]:
+    pipeline = django_rq.get_connection().pipeline()
+    for kind, pk in objects:
+        pipeline.hgetall(_pending_key(kind, pk))
+        pipeline.delete(_pending_key(kind, pk))
+    results = pipeline.execute()
+
+    changes = []
+    for (kind, pk), data in zip(objects, results[::2]):
+        old, new = _parse_pending(data)
+        if old is not None:
+            changes.append((kind, pk, old, new))
+    return changes
+
+
+def _address(state: Optional[dict]) -> Optional[NetAddress]:
+    if state and state.get('address'):
+        return NetAddress(state['address'])
+
+
+class ChangeContext:
+    """
+    Everything needed to turn a set of changes into DNS operations, fetched with a few queries for all of them
+    """
+
+    def __init__(self, changes: List[Change], create_statuses: bool = True):
+        ip_pks = {pk for kind, pk, old, new in changes if kind == KIND_IPADDRESS and new is not None}
+        extra_pks = {pk for kind, pk, old, new in changes if kind == KIND_EXTRA and new is not None}
+        deleted_extra_ip_pks = {old.get('ip_address') for kind, pk, old, new in changes
+                                if kind == KIND_EXTRA and new is None}
+
+        self.extras_by_ip: Dict[int, Dict[str, ExtraDNSName]] = {pk: {} for pk in ip_pks}
+        for extra in ExtraDNSName.objects.filter(ip_address_id__in=ip_pks):
+            self.extras_by_ip[extra.ip_address_id][normalize_fqdn(extra.name)] = extra
+
+        self.extras: Dict[int, ExtraDNSName] = ExtraDNSName.objects.in_bulk(extra_pks)
+
+        self.main_dns_names: Dict[int, str] = dict(
+            IPAddress.objects.filter(pk__in=deleted_extra_ip_pks).values_list('pk', 'dns_name')
+        )
+
+        self.statuses: Dict[int, DNSStatus] = {
+            status.ip_address_id: status for status in DNSStatus.objects.filter(ip_address_id__in=ip_pks)
+        }
+        missing = ip_pks - set(self.statuses)
+        if missing and create_statuses:
+            # Only create status objects for IP addresses that haven't been deleted in the meantime
+            existing = IPAddress.objects.filter(pk__in=missing).values_list('pk', flat=True)
+            DNSStatus.objects.bulk_create([DNSStatus(ip_address_id=pk) for pk in existing], ignore_conflicts=True)
+            for status in DNSStatus.objects.filter(ip_address_id__in=missing):
+                self.statuses[status.ip_address_id] = status
+
+    def operations(self, changes: Iterable[Change]) -> List[BatchOperation]:
+        operations = []
+        for kind, pk, old, new in changes:
+            if kind == KIND_IPADDRESS:
+                operations.extend(self._ipaddress_operations(pk, old, new))
+            else:
+                operations.extend(self._extra_operations(pk, old, new))
+        return operations
+
+    def _ipaddress_operations(self, pk: int, old: dict, new: Optional[dict]) -> List[BatchOperation]:
+        old_address = _address(old)
+        old_dns_name = normalize_fqdn(old.get('dns_name'))
+
+        if new is None:
+            # The IP address has been deleted
+            if old_address and old_dns_name:
+                return [(ACTION_DELETE, old_dns_name, old_address, True, True, None)]
+            return []
+
+        new_address = _address(new)
+        new_dns_name = normalize_fqdn(new.get('dns_name'))
+        if new_address == old_address and new_dns_name == old_dns_name:
+            return []
+
+        extra_dns_names = self.extras_by_ip.get(pk, {})
+        status = self.statuses.get(pk)
+
+        operations = []
+        if old_address and old_dns_name and old_dns_name not in extra_dns_names:
+            operations.append((ACTION_DELETE, old_dns_name, old_address, True, True, status))
+
+        if new_address and new_dns_name:
+            operations.append((ACTION_CREATE, new_dns_name, new_address, True, True, status))
+
+        if old_address != new_address:
+            # This affects extra names
+            for dns_name, extra in extra_dns_names.items():
+                # Don't touch the main dns_name
+                if dns_name == old_dns_name or dns_name == new_dns_name:
+                    continue
+
+                if old_dns_name:
+                    operations.append((ACTION_DELETE, dns_name, old_address, True, False, extra))
+                if new_dns_name:
+                    operations.append((ACTION_CREATE, dns_name, new_address, True, False, extra))
+
+        return operations
+
+    def _extra_operations(self, pk: int, old: dict, new: Optional[dict]) -> List[BatchOperation]:
+        old_address = _address(old)
+        old_dns_name = old.get('name') or ''
+
+        if new is None:
+            # The extra name has been deleted, but leave it alone if it's also the main name of the IP address. When
+            # the IP address has been deleted as well, its name from the time of the delete is used.
+            main_dns_name = normalize_fqdn(self.main_dns_names.get(old.get('ip_address'), old.get('main_dns_name')))
+            if old_address and old_dns_name and old_dns_name != main_dns_name:
+                return [(ACTION_DELETE, old_dns_name, old_address, True, False, None)]
+            return []
+
+        new_address = _address(new)
+        new_dns_name = new.get('name') or ''
+        if new_address == old_address and new_dns_name == old_dns_name:
+            return []
+
+        status = self.extras.get(pk)
+
+        operations = []
+        if old_address and old_dns_name:
+            operations.append((ACTION_DELETE, old_dns_name, old_address, True, False, status))
+        if new_address and new_dns_name:
+            operations.append((ACTION_CREATE, new_dns_name, new_address, True, False, status))
+
+        return operations
+
+
+def apply_changes(changes: List[Change]) -> str:
+    operations = ChangeContext(changes).operations(changes)
+    if not operations:
+        return 'No net change'
+
+    with status_writer.batch():
+        return run_operations(operations)
+
+
+@plugin_job()
+def dns_apply_pending(kind: str, pk: int):
+    """
+    Apply the net change between the state before the first pending change of an object and its latest state
+    """
+    connection = django_rq.get_connection()
+
+    # Don't overlap with a previous job for the same object that is still sending
+    with metrics.measure_job('dns_apply_pending') as timings, \
+            connection.lock(_lock_key(kind, pk), timeout=LOCK_TIMEOUT):
+        old, new = _pop_pending(kind, pk)
+        output = apply_changes([(kind, pk, old, new)]) if old is not None else 'Nothing pending'
+    return timings.result(output)
+
+
+@plugin_job(PRIORITY_BULK)
+def dns_apply_bulk(objects: List[Tuple[str, int]]):
+    """
+    Apply the pending changes of the objects of one bulk operation. The same per-object locks as dns_apply_pending
+    are taken, objects that are locked by such a job are left to a dns_apply_pending job of their own.
+    """
+    connection = django_rq.get_connection()
+    token = uuid.uuid4().hex
+
+    with metrics.measure_job('dns_apply_bulk') as timings:
+        # All locks in one round trip, compatible with the locks of redis-py
+        pipeline = connection.pipeline()
+        for kind, pk in objects:
+            pipeline.set(_lock_key(kind, pk), token, nx=True, ex=LOCK_TIMEOUT)
+        acquired = pipeline.execute()
+        locked = [obj for obj, success in zip(objects, acquired) if success]
+        busy = [obj for obj, success in zip(objects, acquired) if not success]
+
+        try:
+            changes = _pop_many(locked)
+            output = apply_changes(changes) if changes else 'Nothing pending'
+        finally:
+            pipeline = connection.pipeline()
+            for kind, pk in locked:
+                pipeline.delete(_lock_key(kind, pk))
+            pipeline.execute()
+
+    for kind, pk in busy:
+        # Waits for the lock, and finds nothing when the job holding the lock already took the change
+        _schedule_pending(kind, pk)
+    if busy:
+        output += f', {len(busy)} objects left to their own jobs'
+    return timings.result(output)
+
+
+class ChangeCollector(threading.local):
+    """
+    Collects the changes made inside a database transaction and hands them over when it commits. Small transactions
+    go through the per-object coalescing, bulk imports and edits are grouped per zone into a few bulk jobs.
+    """
+
+    def __init__(self):
+        self.changes: Dict[Tuple[str, int], list] = {}
+        self.connection = None
+        self.suspended = False
+
+    @contextmanager
+    def suspend(self):
+        """
+        Ignore the changes made in this thread inside the block, for example while loading or removing test data
+        """
+        self.suspended = True
+        try:
+            yield
+        finally:
+            self.suspended = False
+
+    def _is_registered(self) -> bool:
+        # The commit hook disappears when the transaction (or the savepoint it was registered in) is rolled back
+        return any(entry[1] == self.flush for entry in self.connection.run_on_commit)
+
+    def add(self, kind: str, pk: int, old: dict, new: Optional[dict]):
+        if self.suspended:
+            return
+
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            record_change(kind, pk, old, new)
+            return
+
+        if not self.changes or self.connection is not connection or not self._is_registered():
+            self.changes = {}
+            self.connection = connection
+            transaction.on_commit(self.flush)
+
+        if (kind, pk) in self.changes:
+            # Keep the oldest state, replace the desired state
+            self.changes[(kind, pk)][1] = new
+        else:
+            self.changes[(kind, pk)] = [old, new]
+
+    def flush(self):
+        changes = [(kind, pk, old, new) for (kind, pk), (old, new) in self.changes.items()]
+        self.changes = {}
+        self.connection = None
+
+        if len(changes) <= get_config('bulk_threshold'):
+            for change in changes:
+                record_change(*change)
+            return
+
+        # Group the changes by forward zone, so each job mostly updates one zone
+        zones: Dict[Optional[int], List[Change]] = {}
+        for change in changes:
+            kind, pk, old, new = change
+            state = new or old
+            dns_name = state.get('dns_name') if kind == KIND_IPADDRESS else state.get('name')
+            zone = zone_index.find(normalize_fqdn(dns_name)) if dns_name else None
+            zones.setdefault(zone.pk if zone else None, []).append(change)
+
+        # The changes go through the pending states like single changes, so a later change of the same object can't
+        # be overtaken by a bulk job that has been scheduled for later
+        pipeline = django_rq.get_connection().pipeline()
+        for kind, pk, old, new in changes:
+            _store_pending(pipeline, kind, pk, old, new)
+        pipeline.execute()
+
+        # Jobs that don't fit in the bulk queue are scheduled for later, the request or script doesn't wait
+        jobs = enqueue_bulk(dns_apply_bulk, [([(kind, pk) for kind, pk, old, new in batch],)
+                                             for zone_changes in zones.values() for batch in batched(zone_changes)])
+
+        logger.info(f"Queued {len(changes)} DNS changes in {jobs} bulk jobs")
+
+
+collector = ChangeCollector()
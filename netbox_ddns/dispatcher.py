@@ -0,0 +1,165 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import dns.message
+import dns.rcode
+import dns.update
+
+from .batch import PendingRecord, pack_records
+from .breaker import UNAVAILABLE_ERRORS, breaker
+from .metrics import metrics
+from .transport import send_updates
+from .utils import get_config
+
+logger = logging.getLogger('netbox_ddns')
+
+Message = Tuple[dns.update.Update, List[PendingRecord], bool]
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def send_checked(server, updates: List[dns.update.Update], tcp: bool) -> List[dns.message.Message]:
+    """
+    Send updates and let the circuit breaker of the server know whether it answered
+    """
+    try:
+        responses = send_updates(server, updates, tcp)
+    except UNAVAILABLE_ERRORS:
+        breaker.failure(server)
+        raise
+
+    breaker.success(server)
+    return responses
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=get_config('dispatch_workers'), thread_name_prefix='netbox_ddns')
+    return _executor
+
+
+def waves(messages: Iterable[Message]) -> List[List[Message]]:
+    """
+    Split the messages for one server into waves that are sent one after the other. A message goes into the wave
+    after the last one that touches any of its owner names, so the records for one name are still changed in the
+    order they were submitted, and the messages within a wave can be sent in any order.
+    """
+    result: List[List[Message]] = []
+    last: Dict[str, int] = {}
+    for message in messages:
+        names = {record.name for record in message[1]}
+        wave = max((last[name] + 1 for name in names if name in last), default=0)
+        if wave == len(result):
+            result.append([])
+        result[wave].append(message)
+        for name in names:
+            last[name] = wave
+    return result
+
+
+class Dispatcher:
+    """
+    Sends UPDATE messages from an asyncio event loop, to different servers concurrently. The messages for one server
+    are sent in waves, and each wave is spread over at most server_concurrency batches that send_updates pipelines
+    over one connection each.
+    """
+
+    @staticmethod
+    async def _send(server, updates: List[dns.update.Update], tcp: bool) -> List[dns.message.Message]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), metrics.call_for_job, metrics.timings, send_checked, server,
+                                          updates, tcp)
+
+    async def _send_wave(self, server, messages: List[Message]) -> List[Tuple[PendingRecord, dns.message.Message]]:
+        batches = []
+        for tcp in (False, True):
+            batch = [message for message in messages if message[2] == tcp]
+            count = min(len(batch), get_config('server_concurrency'))
+            batches += [(batch[index::count], tcp) for index in range(count)]
+
+        outcomes = await asyncio.gather(*(self._send(server, [message[0] for message in batch], tcp)
+                                          for batch, tcp in batches), return_exceptions=True)
+
+        results = []
+        retries = []
+        error = None
+        for (batch, tcp), outcome in zip(batches, outcomes):
+            if isinstance(outcome, BaseException):
+                error = error or outcome
+                continue
+
+            for (update, records, _), response in zip(batch, outcome):
+                if response.rcode() == dns.rcode.NOERROR or len(records) == 1:
+                    results.extend((record, response) for record in records)
+                    continue
+
+                logger.warning(f"Update of {len(records)} records in {records[0].zone_name} failed: "
+                               f"{dns.rcode.to_text(response.rcode())}, retrying them one by one")
+                retries.extend(records)
+
+        if error:
+            raise DispatchError(results, error)
+
+        if retries:
+            # Single records, these don't get retried again
+            results.extend(await self._send_server(server, [(record.build_update(), [record], False)
+                                                            for record in retries]))
+        return results
+
+    async def _send_server(self, server, messages: List[Message]) -> List[Tuple[PendingRecord, dns.message.Message]]:
+        results = []
+        for wave in waves(messages):
+            try:
+                results.extend(await self._send_wave(server, wave))
+            except DispatchError as e:
+                # Later waves may depend on this one, so they aren't sent
+                raise DispatchError(results + e.results, e.error)
+        return results
+
+    async def run(self, messages: Iterable[Message]) -> List[Tuple[PendingRecord, dns.message.Message]]:
+        servers: Dict[int, List[Message]] = {}
+        for message in messages:
+            servers.setdefault(message[1][0].server.pk, []).append(message)
+
+        outcomes = await asyncio.gather(*(self._send_server(server_messages[0][1][0].server, server_messages)
+                                          for server_messages in servers.values()), return_exceptions=True)
+
+        results = []
+        error = None
+        for outcome in outcomes:
+            if isinstance(outcome, DispatchError):
+                results.extend(outcome.results)
+                error = error or outcome.error
+            elif isinstance(outcome, BaseException):
+                error = error or outcome
+            else:
+                results.extend(outcome)
+
+        if error:
+            # Let the caller store what did succeed before failing
+            raise DispatchError(results, error)
+
+        return results
+
+
+class DispatchError(Exception):
+    def __init__(self, results: List[Tuple[PendingRecord, dns.message.Message]], error: BaseException):
+        super().__init__(str(error))
+        self.results = results
+        self.error = error
+
+
+def dispatch(records: Iterable[PendingRecord]) -> List[Tuple[PendingRecord, dns.message.Message]]:
+    """
+    Pack the records into UPDATE messages and send them concurrently. Returns each record with the response to
+    the message that carried it, in the order the records were given.
+    """
+    records = list(records)
+    results = asyncio.run(Dispatcher().run(pack_records(records)))
+
+    order = {id(record): index for index, record in enumerate(records)}
+    results.sort(key=lambda result: order[id(result[0])])
+    return results
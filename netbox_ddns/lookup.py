@@ -0,0 +1,201 @@
+import logging
+from typing import Dict, Iterable, Optional, Tuple
+
+from netaddr import ip
+
+from .models import ReverseZone, Zone
+from .utils import SharedIndex, get_config
+
+logger = logging.getLogger('netbox_ddns')
+
+
+def _reversed_labels(dns_name: str):
+    dns_name = dns_name.lower().rstrip('.')
+    return reversed(dns_name.split('.')) if dns_name else ()
+
+
+class _LabelNode:
+    __slots__ = ('children', 'zone')
+
+    def __init__(self):
+        self.children: Dict[str, _LabelNode] = {}
+        self.zone: Optional[Zone] = None
+
+
+class ZoneTrie:
+    """
+    A trie of zone names keyed by their labels in reverse order, so the longest matching suffix of a DNS name can be
+    found by walking from the root towards the host label.
+    """
+
+    def __init__(self, zones):
+        self.root = _LabelNode()
+        for zone in zones:
+            node = self.root
+            for label in _reversed_labels(zone.name):
+                node = node.children.setdefault(label, _LabelNode())
+            node.zone = zone
+
+    def find(self, dns_name: str) -> Optional[Zone]:
+        node = self.root
+        best = node.zone
+        for label in _reversed_labels(dns_name):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.zone is not None:
+                best = node.zone
+
+        return best
+
+
+class ZoneIndex(SharedIndex):
+    cache_key = 'netbox_ddns:zone_index:generation'
+
+    def build(self) -> ZoneTrie:
+        zones = list(Zone.objects.select_related('server'))
+        logger.debug(f"Loaded {len(zones)} forward zones into the zone index")
+        return ZoneTrie(zones)
+
+    def find(self, dns_name: str) -> Optional[Zone]:
+        if not get_config('zone_cache'):
+            return Zone.objects.find_for_dns_name(dns_name)
+
+        return self.get().find(dns_name)
+
+
+zone_index = ZoneIndex()
+
+
+class _RadixNode:
+    __slots__ = ('value', 'length', 'zone', 'children')
+
+    def __init__(self, value: int, length: int, zone: Optional[ReverseZone] = None):
+        self.value = value
+        self.length = length
+        self.zone = zone
+        self.children = [None, None]
+
+
+class RadixTree:
+    """
+    A path-compressed binary radix tree of prefixes for one address family. A lookup walks at most one node per
+    significant bit and returns the zone with the most specific prefix that contains the address.
+    """
+
+    def __init__(self, bits: int):
+        self.bits = bits
+        self.root = _RadixNode(0, 0)
+
+    def _bit(self, value: int, pos: int) -> int:
+        return (value >> (self.bits - pos - 1)) & 1
+
+    def _mask(self, value: int, length: int) -> int:
+        return value >> (self.bits - length) << (self.bits - length)
+
+    def _common_length(self, a: int, b: int) -> int:
+        return self.bits - (a ^ b).bit_length()
+
+    def insert(self, value: int, length: int, zone: ReverseZone):
+        value = self._mask(value, length)
+        node = self.root
+        while True:
+            if node.length == length:
+                node.zone = zone
+                return
+
+            bit = self._bit(value, node.length)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _RadixNode(value, length, zone)
+                return
+
+            common = min(child.length, length, self._common_length(child.value, value))
+            if common == child.length:
+                node = child
+                continue
+
+            # Split the edge towards the child at the point where the prefixes diverge
+            middle = _RadixNode(self._mask(value, common), common)
+            middle.children[self._bit(child.value, common)] = child
+            node.children[bit] = middle
+            if common == length:
+                middle.zone = zone
+            else:
+                middle.children[self._bit(value, common)] = _RadixNode(value, length, zone)
+            return
+
+    def find(self, value: int) -> Optional[ReverseZone]:
+        best = None
+        node = self.root
+        while node is not None:
+            if (value ^ node.value) >> (self.bits - node.length):
+                break
+            if node.zone is not None:
+                best = node.zone
+            if node.length == self.bits:
+                break
+
+            node = node.children[self._bit(value, node.length)]
+
+        return best
+
+
+class ReverseZoneTrees:
+    def __init__(self, zones):
+        self.trees = {
+            4: RadixTree(32),
+            6: RadixTree(128),
+        }
+        for zone in zones:
+            self.trees[zone.prefix.version].insert(int(zone.prefix.network), zone.prefix.prefixlen, zone)
+
+    def find(self, address: ip.IPAddress) -> Optional[ReverseZone]:
+        return self.trees[address.version].find(address.value)
+
+
+class ReverseZoneIndex(SharedIndex):
+    cache_key = 'netbox_ddns:reverse_zone_index:generation'
+
+    def build(self) -> ReverseZoneTrees:
+        zones = list(ReverseZone.objects.select_related('server'))
+        logger.debug(f"Loaded {len(zones)} reverse zones into the reverse zone index")
+        return ReverseZoneTrees(zones)
+
+    def find(self, address: ip.IPAddress) -> Optional[ReverseZone]:
+        if not get_config('zone_cache'):
+            return ReverseZone.objects.find_for_address(address)
+
+        return self.get().find(address)
+
+    def find_many(self, addresses: Iterable[ip.IPAddress]) -> Dict[ip.IPAddress, Optional[ReverseZone]]:
+        """
+        Map many addresses to their reverse zones at once, for resync jobs
+        """
+        if not get_config('zone_cache'):
+            return {address: ReverseZone.objects.find_for_address(address) for address in addresses}
+
+        trees = self.get()
+        return {address: trees.find(address) for address in addresses}
+
+    def find_names(self, addresses: Iterable[ip.IPAddress]) \
+            -> Dict[ip.IPAddress, Tuple[Optional[ReverseZone], Optional[str]]]:
+        """
+        Map many addresses to their reverse zones and PTR record names at once, generating the names per zone in bulk
+        """
+        zones = self.find_many(addresses)
+
+        by_zone: Dict[int, list] = {}
+        for address, zone in zones.items():
+            if zone is not None:
+                by_zone.setdefault(zone.pk, [zone, []])[1].append(address)
+
+        found = {address: (None, None) for address, zone in zones.items() if zone is None}
+        for zone, zone_addresses in by_zone.values():
+            names = zone.record_names([address.value for address in zone_addresses])
+            found.update((address, (zone, name)) for address, name in zip(zone_addresses, names))
+
+        return found
+
+
+reverse_zone_index = ReverseZoneIndex()
@@ -0,0 +1,59 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from netbox_ddns.benchmark import SCALES, SCENARIOS, ptr_names, run
+
+
+def parse_scale(value: str) -> int:
+    if value.lower() in SCALES:
+        return SCALES[value.lower()]
+    try:
+        return int(value)
+    except ValueError:
+        raise CommandError(f"Unknown scale {value}, use {', '.join(SCALES)} or a number")
+
+
+class Command(BaseCommand):
+    help = ("Measure update throughput and latency from the signals through the background jobs to a local stand-in "
+            "DNS server. Creates and removes test data, only run this on a test instance without running workers.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', default='10k',
+                            help=f"Number of IP addresses to generate: {', '.join(SCALES)} or a number")
+        parser.add_argument('--operations', type=int, default=1000,
+                            help="Number of changes per scenario")
+        parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), dest='scenarios',
+                            help="Scenario to run, can be given multiple times, all by default")
+        parser.add_argument('--rate-limit', action='store_true',
+                            help="Keep the adaptive rate limit enabled")
+        parser.add_argument('--keep', action='store_true',
+                            help="Don't remove the generated data afterwards")
+        parser.add_argument('--ptr-names', action='store_true',
+                            help="Only compare generating PTR record names one at a time and in bulk, for --operations "
+                                 "addresses per zone size, without touching the database")
+        parser.add_argument('--output',
+                            help="Write the JSON results to this file instead of standard output")
+
+    def handle(self, *args, **options):
+        if options['ptr_names']:
+            results = ptr_names(options['operations'])
+        else:
+            results = self.run_scenarios(options)
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run_scenarios(self, options) -> dict:
+        return run(
+            scale=parse_scale(options['scale']),
+            operations=options['operations'],
+            scenarios=options['scenarios'] or list(SCENARIOS),
+            rate_limit=options['rate_limit'],
+            keep=options['keep'],
+            log=lambda message: self.stderr.write(message),
+        )
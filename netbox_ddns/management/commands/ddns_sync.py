@@ -0,0 +1,86 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from netbox_ddns.changelog import incremental_sync
+from netbox_ddns.models import ReverseZone, Zone
+from netbox_ddns.resync import KIND_FORWARD, KIND_REVERSE
+from netbox_ddns.sync import MODE_INCREMENTAL, MODE_PUSH, MODE_RECONCILE, run_pool
+from netbox_ddns.utils import normalize_fqdn
+
+
+class Command(BaseCommand):
+    help = "Synchronise the DNS records of all or the given forward and reverse zones with their DDNS servers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('zones', nargs='*', metavar='zone',
+                            help="Names of the zones to synchronise, all zones if none are given")
+        parser.add_argument('--forward', action='store_true',
+                            help="Only synchronise forward zones")
+        parser.add_argument('--reverse', action='store_true',
+                            help="Only synchronise reverse zones")
+        parser.add_argument('--mode', choices=[MODE_PUSH, MODE_RECONCILE, MODE_INCREMENTAL], default=MODE_PUSH,
+                            help="'push' sends all records again, 'reconcile' transfers each zone with AXFR and only "
+                                 "sends the differences, 'incremental' applies the change log since the last run")
+        parser.add_argument('--workers', type=int, default=min(os.cpu_count() or 1, 8),
+                            help="Number of zones to synchronise in parallel processes")
+        parser.add_argument('--force', action='store_true',
+                            help="Also push records that haven't changed since they were last added successfully")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report how many records would be sent, or added and deleted when reconciling")
+
+    def get_tasks(self, options) -> list:
+        names = {normalize_fqdn(name) for name in options['zones']}
+        both = options['forward'] == options['reverse']
+
+        zones = []
+        if options['forward'] or both:
+            zones += [(KIND_FORWARD, zone) for zone in Zone.objects.order_by('name')]
+        if options['reverse'] or both:
+            zones += [(KIND_REVERSE, zone) for zone in ReverseZone.objects.order_by('name')]
+
+        if names:
+            unknown = names - {zone.name for kind, zone in zones}
+            if unknown:
+                raise CommandError(f"Unknown zones: {', '.join(sorted(unknown))}")
+            zones = [(kind, zone) for kind, zone in zones if zone.name in names]
+
+        return [(kind, zone.pk, options['mode'], options['dry_run'], options['force']) for kind, zone in zones]
+
+    @staticmethod
+    def describe(result: dict, dry_run: bool) -> str:
+        if 'error' in result:
+            return f"failed: {result['error']}"
+
+        if 'adds' in result:
+            verb = 'would add' if dry_run else 'added'
+            summary = f"{verb} {result['adds']}, {'would delete' if dry_run else 'deleted'} {result['deletes']}"
+            if result['messages']:
+                summary += f" in {result['messages']} messages"
+        else:
+            summary = f"{'would send' if dry_run else 'sent'} {result['records']} records"
+
+        return f"{summary} ({result['seconds']:.1f}s)"
+
+    def handle(self, *args, **options):
+        if options['mode'] == MODE_INCREMENTAL:
+            if options['zones'] or options['forward'] or options['reverse']:
+                raise CommandError("Incremental synchronisation always covers all zones")
+            output, _ = incremental_sync(dry_run=options['dry_run'])
+            self.stdout.write(output)
+            return
+
+        tasks = self.get_tasks(options)
+        if not tasks:
+            self.stdout.write("No zones to synchronise")
+            return
+
+        failed = 0
+        for done, result in enumerate(run_pool(tasks, options['workers']), start=1):
+            failed += 'error' in result
+            description = self.describe(result, options['dry_run'])
+            line = f"[{done}/{len(tasks)}] {result['zone']} ({result['kind']}): {description}"
+            self.stdout.write(self.style.ERROR(line) if 'error' in result else line)
+
+        if failed:
+            raise CommandError(f"{failed} of {len(tasks)} zones failed")
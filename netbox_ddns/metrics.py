@@ -0,0 +1,416 @@
+import json
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import timezone
+from typing import Dict, List, Optional, Tuple
+
+import django_rq
+import dns.rcode
+from django.db import connection as db_connection
+from rq import Queue, get_current_job
+
+from .breaker import STATE_CLOSED, breaker, parked_queue_name
+from .models import RCODE_NO_ZONE, Server
+from .ratelimit import rate_limiter
+
+logger = logging.getLogger('netbox_ddns')
+
+METRICS_KEY = 'netbox_ddns:metrics'
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, float('inf'))
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# Name: (type, help)
+FAMILIES = {
+    'netbox_ddns_updates_total':
+        (COUNTER, 'Records sent or skipped, by response code'),
+    'netbox_ddns_unchanged_total':
+        (COUNTER, 'Records not sent because the server already has them'),
+    'netbox_ddns_parked_total':
+        (COUNTER, 'Records parked because their server was unavailable'),
+    'netbox_ddns_update_latency_seconds':
+        (HISTOGRAM, 'Time from the change to the job start (queued), to the response (processing) and in total'),
+    'netbox_ddns_soa_check_seconds':
+        (HISTOGRAM, 'Time spent finding the zone cut with an SOA lookup'),
+    'netbox_ddns_delegation_cache_lookups_total':
+        (COUNTER, 'Zone cut lookups in the delegation cache of the workers, by result'),
+    'netbox_ddns_job_duration_seconds':
+        (HISTOGRAM, 'Duration of background jobs'),
+    'netbox_ddns_job_db_seconds':
+        (HISTOGRAM, 'Time background jobs spent in database queries'),
+    'netbox_ddns_queue_depth':
+        (GAUGE, 'Jobs waiting in RQ queues, including the parked queues of unavailable servers'),
+    'netbox_ddns_server_rate':
+        (GAUGE, 'Current update rate limit per DDNS server in messages per second'),
+    'netbox_ddns_server_available':
+        (GAUGE, 'Whether the circuit breaker of a DDNS server is closed'),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Where the time of a job goes: finding the zone, the SOA lookup, resolving the server address, waiting for the rate
+# limit, the UPDATE round trips, saving the results and all database queries together
+PHASES = ('zone_lookup', 'soa', 'address', 'rate_wait', 'round_trip', 'status_save', 'db')
+
+# Phases that are spent on one server, the others are counted for every server the job updated
+SERVER_PHASES = ('zone_lookup', 'soa', 'address', 'rate_wait', 'round_trip')
+
+# The timings of this many recent jobs are kept per server
+TIMINGS_KEEP = 100
+TIMINGS_EXPIRY = 7 * 86400
+
+
+def rcode_text(code: int) -> str:
+    if code == RCODE_NO_ZONE:
+        return 'NO_ZONE'
+    return dns.rcode.to_text(code)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labels: Labels) -> str:
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in labels)
+
+
+def _format_le(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+class JobTimings:
+    """
+    The phase timings, response codes and traffic of one background job. Updates are sent from multiple threads,
+    so everything is guarded by a lock.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.seconds = 0.0
+        self.phases: Dict[str, float] = defaultdict(float)
+        self.server_phases: Dict[int, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.rcodes = Counter()
+        self.messages = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float, server=None):
+        with self.lock:
+            self.phases[phase] += seconds
+            if server is not None and server.pk is not None:
+                self.server_phases[server.pk][phase] += seconds
+
+    def sent(self, server, size: int):
+        with self.lock:
+            self.messages += 1
+            self.bytes_sent += size
+            if server.pk is not None:
+                self.server_phases[server.pk]['bytes_sent'] += size
+
+    def result(self, output: str) -> dict:
+        return {
+            'output': output,
+            'seconds': round(self.seconds, 6),
+            'phases': {phase: round(self.phases.get(phase, 0.0), 6) for phase in PHASES},
+            'rcodes': dict(self.rcodes),
+            'messages': self.messages,
+            'bytes_sent': self.bytes_sent,
+        }
+
+    def per_server(self) -> Dict[int, dict]:
+        summaries = {}
+        for server_pk, phases in self.server_phases.items():
+            summaries[server_pk] = {
+                'job': self.name,
+                'seconds': self.seconds,
+                'phases': {
+                    phase: phases.get(phase, 0.0) if phase in SERVER_PHASES else self.phases.get(phase, 0.0)
+                    for phase in PHASES
+                },
+                'bytes_sent': int(phases.get('bytes_sent', 0)),
+            }
+        return summaries
+
+
+def _timings_key(server_pk: int) -> str:
+    return f'netbox_ddns:timings:{server_pk}'
+
+
+class Metrics:
+    """
+    Counters and histograms shared by all workers. Observations are added up in memory and written to a Redis hash
+    in one round trip when a job is done, the metrics view renders that hash.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[str, float] = defaultdict(float)
+        # The job running in this thread, threads that send updates for a job are given its timings
+        self._job = threading.local()
+
+    @property
+    def timings(self) -> Optional[JobTimings]:
+        return getattr(self._job, 'timings', None)
+
+    def call_for_job(self, timings: Optional[JobTimings], func, *args):
+        """
+        Call func in this thread, adding the phases and traffic it measures to the timings of a job running in another
+        thread
+        """
+        self._job.timings = timings
+        try:
+            return func(*args)
+        finally:
+            self._job.timings = None
+
+    @staticmethod
+    def _field(sample: str, labels: Labels, le: str = '') -> str:
+        return f'{sample}|{_format_labels(labels)}|{le}'
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        field = self._field(name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._pending[field] += amount
+
+    def observe(self, name: str, value: float, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            # Only buckets that grow are written, render() adds the ones that are still empty
+            for bound in BUCKETS:
+                if value <= bound:
+                    self._pending[self._field(name + '_bucket', labels, _format_le(bound))] += 1
+            self._pending[self._field(name + '_sum', labels)] += value
+            self._pending[self._field(name + '_count', labels)] += 1
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(float)
+
+        if not pending:
+            return
+
+        try:
+            pipeline = django_rq.get_connection().pipeline(transaction=False)
+            for field, amount in pending.items():
+                pipeline.hincrbyfloat(METRICS_KEY, field, amount)
+            pipeline.execute()
+        except Exception:
+            # Metrics must never break updates
+            logger.exception("Couldn't store metrics")
+
+    @contextmanager
+    def measure_job(self, name: str):
+        """
+        Measure the duration and database time of a background job, and remember when the change that caused it was
+        made, which is when the job was created
+        """
+        job = get_current_job()
+        started = time.time()
+        created = started
+        if job and job.created_at:
+            created_at = job.created_at
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            created = min(created_at.timestamp(), started)
+
+        timings = JobTimings(name)
+
+        def timed_query(execute, sql, params, many, context):
+            start = time.monotonic()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                timings.add('db', time.monotonic() - start)
+
+        self._job.times = (created, started)
+        self._job.timings = timings
+        try:
+            with db_connection.execute_wrapper(timed_query):
+                yield timings
+        finally:
+            self._job.times = None
+            self._job.timings = None
+            timings.seconds = time.time() - started
+            self.observe('netbox_ddns_job_duration_seconds', timings.seconds, job=name)
+            self.observe('netbox_ddns_job_db_seconds', timings.phases.get('db', 0.0), job=name)
+            self.flush()
+            self.store_timings(timings)
+
+    @contextmanager
+    def phase(self, name: str, server=None):
+        """
+        Add the time spent in the block to a phase of the current job
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.monotonic() - start, server)
+
+    def add_phase(self, name: str, seconds: float, server=None):
+        timings = self.timings
+        if timings:
+            timings.add(name, seconds, server)
+
+    def record_sent(self, server, size: int):
+        timings = self.timings
+        if timings:
+            timings.sent(server, size)
+
+    @staticmethod
+    def store_timings(timings: JobTimings):
+        try:
+            pipeline = django_rq.get_connection().pipeline(transaction=False)
+            for server_pk, summary in timings.per_server().items():
+                key = _timings_key(server_pk)
+                pipeline.lpush(key, json.dumps(summary))
+                pipeline.ltrim(key, 0, TIMINGS_KEEP - 1)
+                pipeline.expire(key, TIMINGS_EXPIRY)
+            pipeline.execute()
+        except Exception:
+            logger.exception("Couldn't store job timings")
+
+    def record_response(self, server, zone_name: str, code: int):
+        self.inc('netbox_ddns_updates_total', server=server.server, zone=zone_name, rcode=rcode_text(code))
+
+        timings = self.timings
+        if timings:
+            with timings.lock:
+                timings.rcodes[rcode_text(code)] += 1
+
+        times = getattr(self._job, 'times', None)
+        if times:
+            now = time.time()
+            created, started = times
+            for phase, value in (('queued', started - created), ('processing', now - started),
+                                 ('total', now - created)):
+                self.observe('netbox_ddns_update_latency_seconds', value, server=server.server, zone=zone_name,
+                             phase=phase)
+
+    def record_unsent(self, server, zone_name: str, code: int):
+        self.inc('netbox_ddns_updates_total', server=server.server if server else '', zone=zone_name,
+                 rcode=rcode_text(code))
+
+        timings = self.timings
+        if timings:
+            with timings.lock:
+                timings.rcodes[rcode_text(code)] += 1
+
+    def record_unchanged(self, server, zone_name: str):
+        self.inc('netbox_ddns_unchanged_total', server=server.server, zone=zone_name)
+
+    def record_parked(self, server, count: int):
+        self.inc('netbox_ddns_parked_total', count, server=server.server)
+
+    @contextmanager
+    def soa_timer(self):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe('netbox_ddns_soa_check_seconds', time.monotonic() - start)
+
+    def reset(self):
+        with self._lock:
+            self._pending.clear()
+        django_rq.get_connection().delete(METRICS_KEY)
+
+
+metrics = Metrics()
+
+
+def server_summary(server_pk: int) -> Tuple[int, Dict[str, Tuple[float, float]]]:
+    """
+    The number of recent jobs for a server, and the mean and 95th percentile of each phase over those jobs
+    """
+    entries = [json.loads(entry) for entry in django_rq.get_connection().lrange(_timings_key(server_pk), 0, -1)]
+
+    summary = {}
+    for phase in PHASES + ('total',):
+        values = sorted(entry['seconds'] if phase == 'total' else entry['phases'].get(phase, 0.0)
+                        for entry in entries)
+        if values:
+            p95 = values[max(0, -(-len(values) * 95 // 100) - 1)]
+            summary[phase] = (sum(values) / len(values), p95)
+
+    return len(entries), summary
+
+
+def _gauges() -> List[Tuple[str, Labels, float]]:
+    from django_rq.settings import QUEUES
+
+    samples = []
+    connection = django_rq.get_connection()
+    for name in QUEUES:
+        queue = django_rq.get_queue(name)
+        samples.append(('netbox_ddns_queue_depth', (('queue', name),), queue.count))
+        samples.append(('netbox_ddns_queue_depth', (('queue', name + ':scheduled'),),
+                        queue.scheduled_job_registry.count))
+
+    for server in Server.objects.all():
+        labels = (('server', server.server),)
+        parked = Queue(parked_queue_name(server.pk), connection=connection)
+        samples.append(('netbox_ddns_queue_depth', (('queue', parked.name),), parked.count))
+        samples.append(('netbox_ddns_server_rate', labels, rate_limiter.current_rate(server)))
+        # Only read the state, allow() would schedule a lost probe and a scrape mustn't change anything
+        samples.append(('netbox_ddns_server_available', labels, 1 if breaker.state(server) == STATE_CLOSED else 0))
+
+    return samples
+
+
+def _family(sample: str) -> str:
+    for suffix in ('_bucket', '_sum', '_count'):
+        if sample.endswith(suffix) and sample[:-len(suffix)] in FAMILIES:
+            return sample[:-len(suffix)]
+    return sample
+
+
+def _sort_key(line: Tuple[str, str, str]):
+    sample, labels, le = line
+    order = {'_bucket': 0, '_sum': 1, '_count': 2}
+    suffix = sample[len(_family(sample)):]
+    return labels, order.get(suffix, 0), float(le.replace('+Inf', 'inf')) if le else 0.0
+
+
+def render() -> str:
+    """
+    Render all metrics in the Prometheus text exposition format
+    """
+    stored = django_rq.get_connection().hgetall(METRICS_KEY)
+
+    samples: Dict[str, List[Tuple[Tuple[str, str, str], str]]] = defaultdict(list)
+    buckets = set()
+    for field, value in stored.items():
+        sample, labels, le = field.decode().split('|')
+        samples[_family(sample)].append(((sample, labels, le), value.decode()))
+        if le:
+            buckets.add((sample, labels, le))
+
+    # Buckets are cumulative, one that was never written has no observations at or below its bound
+    for sample, labels, le in list(buckets):
+        for bound in BUCKETS:
+            if (sample, labels, _format_le(bound)) not in buckets:
+                buckets.add((sample, labels, _format_le(bound)))
+                samples[_family(sample)].append(((sample, labels, _format_le(bound)), '0'))
+
+    for name, labels, value in _gauges():
+        samples[name].append(((name, _format_labels(labels), ''), repr(float(value))))
+
+    lines = []
+    for family, (kind, description) in FAMILIES.items():
+        lines.append(f'# HELP {family} {description}')
+        lines.append(f'# TYPE {family} {kind}')
+        for (sample, labels, le), value in sorted(samples.get(family, []), key=lambda item: _sort_key(item[0])):
+            if le:
+                labels = f'{labels},le="{le}"' if labels else f'le="{le}"'
+            lines.append(f'{sample}{{{labels}}} {value}' if labels else f'{sample} {value}')
+
+    return '\n'.join(lines) + '\n'
+
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.9 on 2026-10-16 09:12
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_ddns', '0010_extradnsname_created_extradnsname_custom_field_data_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='server',
+            name='max_rate',
+            field=models.PositiveIntegerField(blank=True, help_text='maximum number of UPDATE messages per second, the plugin default if empty', null=True, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Maximum rate'),
+        ),
+    ]
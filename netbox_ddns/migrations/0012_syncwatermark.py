@@ -0,0 +1,26 @@
+# Generated by Django 5.0.9 on 2026-10-16 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_ddns', '0011_server_max_rate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='name')),
+                ('last_change_id', models.BigIntegerField(default=0, help_text='the last change log entry that has been applied', verbose_name='last change')),
+                ('last_update', models.DateTimeField(auto_now=True, verbose_name='last update')),
+            ],
+            options={
+                'verbose_name': 'sync watermark',
+                'verbose_name_plural': 'sync watermarks',
+            },
+        ),
+    ]
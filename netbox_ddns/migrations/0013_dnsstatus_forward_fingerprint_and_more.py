@@ -0,0 +1,28 @@
+# Generated by Django 5.0.9 on 2026-10-16 14:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_ddns', '0012_syncwatermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dnsstatus',
+            name='forward_fingerprint',
+            field=models.CharField(blank=True, default='', help_text='identifies the forward record that was last added successfully', max_length=16, verbose_name='forward record fingerprint'),
+        ),
+        migrations.AddField(
+            model_name='dnsstatus',
+            name='reverse_fingerprint',
+            field=models.CharField(blank=True, default='', help_text='identifies the reverse record that was last added successfully', max_length=16, verbose_name='reverse record fingerprint'),
+        ),
+        migrations.AddField(
+            model_name='extradnsname',
+            name='forward_fingerprint',
+            field=models.CharField(blank=True, default='', help_text='identifies the forward record that was last added successfully', max_length=16, verbose_name='forward record fingerprint'),
+        ),
+    ]
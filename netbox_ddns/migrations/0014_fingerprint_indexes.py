@@ -0,0 +1,28 @@
+# Generated by Django 5.0.9 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_ddns', '0013_dnsstatus_forward_fingerprint_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dnsstatus',
+            name='forward_fingerprint',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='identifies the forward record that was last added successfully', max_length=16, verbose_name='forward record fingerprint'),
+        ),
+        migrations.AlterField(
+            model_name='dnsstatus',
+            name='reverse_fingerprint',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='identifies the reverse record that was last added successfully', max_length=16, verbose_name='reverse record fingerprint'),
+        ),
+        migrations.AlterField(
+            model_name='extradnsname',
+            name='forward_fingerprint',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='identifies the forward record that was last added successfully', max_length=16, verbose_name='forward record fingerprint'),
+        ),
+    ]
@@ -1,7 +1,7 @@
+import dns.name
 import dns.tsigkeyring
 import dns.update
 import logging
-import socket
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models.functions import Length
@@ -11,10 +11,12 @@ from django.urls import reverse
 from dns import rcode
 from dns.tsig import HMAC_MD5, HMAC_SHA1, HMAC_SHA224, HMAC_SHA256, HMAC_SHA384, HMAC_SHA512
 from netaddr import IPNetwork, ip
-from typing import Optional
+from typing import Dict, Iterable, List, Optional, Tuple
 from netbox.models import NetBoxModel
 from ipam.fields import IPNetworkField
 from ipam.models import IPAddress
+from .address_cache import server_addresses
+from .ptr import ptr_names
 from .utils import normalize_fqdn
 from .validators import HostnameAddressValidator, HostnameValidator, validate_base64, MinValueValidator, MaxValueValidator
 
@@ -40,6 +42,9 @@ ACTION_CHOICES = (
 # Use a private rcode for internal errors
 RCODE_NO_ZONE = 4095
 
+# Parsed TSIG keyrings and key names, by server pk and key material
+_keyrings: Dict[Tuple[Optional[int], Tuple[str, str, str]], Tuple[dict, dns.name.Name]] = {}
+
 
 def get_rcode_display(code):
     if code is None:
@@ -92,6 +97,13 @@ class Server(models.Model):
         validators=[validate_base64],
         help_text=_('in base64 notation'),
     )
+    max_rate = models.PositiveIntegerField(
+        verbose_name=_('Maximum rate'),
+        blank=True,
+        null=True,
+        validators=[MinValueValidator(1)],
+        help_text=_('maximum number of UPDATE messages per second, the plugin default if empty'),
+    )
 
     class Meta:
         unique_together = (
@@ -113,18 +125,31 @@ class Server(models.Model):
 
     @property
     def address(self) -> Optional[str]:
-        addrinfo = socket.getaddrinfo(self.server, self.server_port, proto=socket.IPPROTO_UDP)
-        for family, _, _, _, sockaddr in addrinfo:
-            if family in (socket.AF_INET, socket.AF_INET6) and sockaddr[0]:
-                return sockaddr[0]
+        return server_addresses.resolve(self.server, self.server_port)
+
+    def get_keyring(self) -> Tuple[dict, dns.name.Name]:
+        fingerprint = (self.tsig_key_name, self.tsig_algorithm, self.tsig_key)
+        cached = _keyrings.get((self.pk, fingerprint))
+        if cached is None:
+            keyring = dns.tsigkeyring.from_text({
+                self.tsig_key_name: self.tsig_key
+            })
+            cached = (keyring, next(iter(keyring)))
+            if self.pk is not None:
+                _keyrings[(self.pk, fingerprint)] = cached
+
+        return cached
+
+    def forget_keyring(self):
+        for key in [key for key in _keyrings if key[0] == self.pk]:
+            _keyrings.pop(key, None)
 
     def create_update(self, zone: str) -> dns.update.Update:
+        keyring, keyname = self.get_keyring()
         return dns.update.Update(
             zone=normalize_fqdn(zone),
-            keyring=dns.tsigkeyring.from_text({
-                self.tsig_key_name: self.tsig_key
-            }),
-            keyname=self.tsig_key_name,
+            keyring=keyring,
+            keyname=keyname,
             keyalgorithm=self.tsig_algorithm
         )
 
@@ -234,6 +259,13 @@ class ReverseZone(models.Model):
 
         return record_name
 
+    def record_names(self, values: Iterable[int]) -> List[str]:
+        """
+        The record names of many addresses in this zone at once, given as integers, identical to record_name
+        """
+        prefix = IPNetwork(self.prefix)
+        return ptr_names(prefix.version, values, prefix.prefixlen, self.name)
+
     def clean(self):
         if isinstance(self.prefix, IPNetwork) and self.prefix.version == 4:
             if self.prefix.prefixlen not in [0, 8, 16, 24] and not self.name:
@@ -268,7 +300,29 @@ class ReverseZone(models.Model):
         self.name = normalize_fqdn(self.name)
 
 
-class DNSStatus(models.Model):
+class LoadedValuesMixin:
+    """
+    Remembers the field values as they were loaded from the database, so background jobs can save only the fields
+    they changed and don't overwrite what other jobs saved in the meantime
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def changed_fields(self, fields: Iterable[str]) -> List[str]:
+        loaded = getattr(self, '_loaded_values', {})
+        return [field for field in fields if field not in loaded or getattr(self, field) != loaded[field]]
+
+    def mark_saved(self, fields: Iterable[str]):
+        loaded = self.__dict__.setdefault('_loaded_values', {})
+        for field in fields:
+            loaded[field] = getattr(self, field)
+
+
+class DNSStatus(LoadedValuesMixin, models.Model):
     ip_address = models.OneToOneField(
         to=IPAddress,
         verbose_name=_('IP address'),
@@ -304,6 +358,23 @@ class DNSStatus(models.Model):
         null=True,
     )
 
+    forward_fingerprint = models.CharField(
+        verbose_name=_('forward record fingerprint'),
+        max_length=16,
+        blank=True,
+        default='',
+        db_index=True,
+        help_text=_('identifies the forward record that was last added successfully'),
+    )
+    reverse_fingerprint = models.CharField(
+        verbose_name=_('reverse record fingerprint'),
+        max_length=16,
+        blank=True,
+        default='',
+        db_index=True,
+        help_text=_('identifies the reverse record that was last added successfully'),
+    )
+
     class Meta:
         verbose_name = _('DNS status')
         verbose_name_plural = _('DNS status')
@@ -325,7 +396,7 @@ class DNSStatus(models.Model):
         return format_html('<span style="color:{colour}">{output}</span', colour=colour, output=output)
 
 
-class ExtraDNSName(NetBoxModel):
+class ExtraDNSName(LoadedValuesMixin, NetBoxModel):
     ip_address = models.ForeignKey(
         to=IPAddress,
         verbose_name=_('IP address'),
@@ -353,8 +424,14 @@ class ExtraDNSName(NetBoxModel):
         blank=True,
         null=True,
     )
-
-    before_save = None
+    forward_fingerprint = models.CharField(
+        verbose_name=_('forward record fingerprint'),
+        max_length=16,
+        blank=True,
+        default='',
+        db_index=True,
+        help_text=_('identifies the forward record that was last added successfully'),
+    )
 
     class Meta:
         unique_together = (
@@ -380,3 +457,27 @@ class ExtraDNSName(NetBoxModel):
         output = get_rcode_display(self.forward_rcode)
         colour = 'green' if self.forward_rcode == rcode.NOERROR else 'red'
         return format_html('<span style="color:{colour}">{output}</span', colour=colour, output=output)
+
+
+class SyncWatermark(models.Model):
+    name = models.CharField(
+        verbose_name=_('name'),
+        max_length=50,
+        unique=True,
+    )
+    last_change_id = models.BigIntegerField(
+        verbose_name=_('last change'),
+        default=0,
+        help_text=_('the last change log entry that has been applied'),
+    )
+    last_update = models.DateTimeField(
+        verbose_name=_('last update'),
+        auto_now=True,
+    )
+
+    class Meta:
+        verbose_name = _('sync watermark')
+        verbose_name_plural = _('sync watermarks')
+
+    def __str__(self):
+        return self.name
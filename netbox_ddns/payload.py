@@ -0,0 +1,125 @@
+"""
+The compact form in which operations and records travel through Redis as job arguments. Only plain values are
+stored: addresses as packed bytes and status objects as a kind and primary key. Workers fetch the status objects when
+they run the job, instead of saving a copy that was made when the job was queued.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from netaddr import IPAddress as NetAddress, ip
+
+from ipam.models import IPAddress
+from .batch import PendingRecord
+from .models import DNSStatus, ExtraDNSName, Server
+
+# A DNSStatus, referenced by the primary key of its IP address so the worker can create it when it doesn't exist yet
+STATUS_IPADDRESS = 'ip'
+
+# An ExtraDNSName, referenced by its own primary key
+STATUS_EXTRA = 'extra'
+
+# (kind, primary key)
+StatusRef = Tuple[str, int]
+
+# (action, normalized DNS name, packed address, forward, reverse, status reference or None)
+CompactOperation = Tuple[int, str, bytes, bool, bool, Optional[StatusRef]]
+
+# (server primary key, zone name, action, name, ttl, rdtype, rdata, status reference or None, status field, operation)
+CompactRecord = Tuple[int, str, int, str, int, str, str, Optional[StatusRef], str, str]
+
+
+def pack_address(address: ip.IPAddress) -> bytes:
+    return address.packed
+
+
+def unpack_address(data: bytes) -> ip.IPAddress:
+    return NetAddress(int.from_bytes(data, 'big'), 4 if len(data) == 4 else 6)
+
+
+def status_ref(status: Optional[DNSStatus | ExtraDNSName]) -> Optional[StatusRef]:
+    if status is None:
+        return None
+    if isinstance(status, DNSStatus):
+        return STATUS_IPADDRESS, status.ip_address_id
+    return STATUS_EXTRA, status.pk
+
+
+def fetch_statuses(refs: Iterable[Optional[StatusRef]]) -> Dict[StatusRef, DNSStatus | ExtraDNSName]:
+    """
+    Fetch the status objects for many references with two queries, creating the DNSStatus objects that don't exist
+    yet. References to deleted objects are left out.
+    """
+    ip_pks = set()
+    extra_pks = set()
+    for ref in refs:
+        if ref is None:
+            continue
+        if ref[0] == STATUS_IPADDRESS:
+            ip_pks.add(ref[1])
+        else:
+            extra_pks.add(ref[1])
+
+    statuses = {}
+    if ip_pks:
+        statuses.update(((STATUS_IPADDRESS, status.ip_address_id), status)
+                        for status in DNSStatus.objects.filter(ip_address_id__in=ip_pks))
+        missing = ip_pks - {pk for kind, pk in statuses}
+        if missing:
+            # Only for IP addresses that haven't been deleted in the meantime
+            existing = IPAddress.objects.filter(pk__in=missing).values_list('pk', flat=True)
+            DNSStatus.objects.bulk_create([DNSStatus(ip_address_id=pk) for pk in existing], ignore_conflicts=True)
+            statuses.update(((STATUS_IPADDRESS, status.ip_address_id), status)
+                            for status in DNSStatus.objects.filter(ip_address_id__in=missing))
+    if extra_pks:
+        statuses.update(((STATUS_EXTRA, pk), extra) for pk, extra in ExtraDNSName.objects.in_bulk(extra_pks).items())
+
+    return statuses
+
+
+def pack_operations(operations: Iterable[tuple]) -> List[CompactOperation]:
+    return [
+        (action, dns_name, pack_address(address), forward, reverse, status_ref(status))
+        for action, dns_name, address, forward, reverse, status in operations
+    ]
+
+
+def unpack_operations(operations: List[CompactOperation]) -> List[tuple]:
+    statuses = fetch_statuses(ref for *_, ref in operations)
+    return [
+        (action, dns_name, unpack_address(address), forward, reverse, statuses.get(ref) if ref else None)
+        for action, dns_name, address, forward, reverse, ref in operations
+    ]
+
+
+def pack_records(records: Iterable[PendingRecord]) -> List[CompactRecord]:
+    return [
+        (record.server.pk, record.zone_name, record.action, record.name, record.ttl, record.rdtype, record.rdata,
+         status_ref(record.status), record.status_field, record.operation)
+        for record in records
+    ]
+
+
+def unpack_records(records: List[CompactRecord]) -> List[PendingRecord]:
+    servers = Server.objects.in_bulk({record[0] for record in records})
+    statuses = fetch_statuses(record[7] for record in records)
+
+    unpacked = []
+    for server_pk, zone_name, action, name, ttl, rdtype, rdata, ref, status_field, operation in records:
+        server = servers.get(server_pk)
+        if server is None:
+            # The server has been deleted, and its zones with it
+            continue
+
+        unpacked.append(PendingRecord(
+            server=server,
+            zone_name=zone_name,
+            action=action,
+            name=name,
+            ttl=ttl,
+            rdtype=rdtype,
+            rdata=rdata,
+            status=statuses.get(ref) if ref else None,
+            status_field=status_field,
+            operation=operation,
+        ))
+
+    return unpacked
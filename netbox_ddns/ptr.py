@@ -0,0 +1,63 @@
+"""
+PTR owner names for many addresses at once. Produces exactly what ReverseZone.record_name produces, but works on
+integer addresses and builds each name with a few C-level operations instead of one string concatenation per octet
+or nibble.
+"""
+from typing import Iterable, List
+
+# The label of every octet value, with the dot that follows it
+OCTET_LABELS = [f'{octet}.' for octet in range(256)]
+
+# The labels of every pair of octets, low octet first as in a reverse name, built on first use
+_pair_labels: List[str] = []
+
+
+def _get_pair_labels() -> List[str]:
+    if not _pair_labels:
+        _pair_labels.extend(low + high for high in OCTET_LABELS for low in OCTET_LABELS)
+    return _pair_labels
+
+
+def ipv4_names(values: Iterable[int], prefixlen: int, zone_name: str) -> List[str]:
+    """
+    PTR owner names of IPv4 addresses given as integers, in a reverse zone for a prefix of the given length. The
+    octets that are completely covered by the prefix are part of the zone name, the others are prepended to it.
+    """
+    octets = 4 - prefixlen // 8
+    labels = OCTET_LABELS
+
+    if octets == 0:
+        return [zone_name for _ in values]
+    if octets == 1:
+        return [labels[value & 0xff] + zone_name for value in values]
+    if octets == 2:
+        pairs = _get_pair_labels()
+        return [pairs[value & 0xffff] + zone_name for value in values]
+    if octets == 3:
+        pairs = _get_pair_labels()
+        return [pairs[value & 0xffff] + labels[(value >> 16) & 0xff] + zone_name for value in values]
+
+    pairs = _get_pair_labels()
+    return [pairs[value & 0xffff] + pairs[(value >> 16) & 0xffff] + zone_name for value in values]
+
+
+def ipv6_names(values: Iterable[int], prefixlen: int, zone_name: str) -> List[str]:
+    """
+    PTR owner names of IPv6 addresses given as integers, in a reverse zone for a prefix of the given length. The
+    nibbles that are completely covered by the prefix are part of the zone name, the others are prepended to it.
+    """
+    nibbles = 32 - prefixlen // 4
+    if nibbles == 0:
+        return [zone_name for _ in values]
+
+    # Only the nibbles below the prefix matter: format them, reverse the digits and put a dot after each one
+    mask = (1 << (nibbles * 4)) - 1
+    width = f'0{nibbles}x'
+    suffix = '.' + zone_name
+    return ['.'.join(format(value & mask, width)[::-1]) + suffix for value in values]
+
+
+def ptr_names(version: int, values: Iterable[int], prefixlen: int, zone_name: str) -> List[str]:
+    if version == 4:
+        return ipv4_names(values, prefixlen, zone_name)
+    return ipv6_names(values, prefixlen, zone_name)
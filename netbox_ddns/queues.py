@@ -0,0 +1,61 @@
+"""
+Interactive work (a single edit, the recreate button, probing a server) and bulk work (bulk edits, resyncs,
+reconciles, parked work) go to separate RQ queues, so a single edit doesn't wait behind a resync of a large zone. Long
+bulk work is split into jobs of one chunk each, and a resync or incremental sync queues its next chunk when it is done,
+so workers take the interactive jobs that were queued in the meantime first. Code that queues many bulk jobs at once
+schedules the ones that don't fit in the bulk queue for later instead of waiting for room.
+"""
+import logging
+from datetime import timedelta
+from typing import Iterable
+
+import django_rq
+from django_rq import job
+from rq import Queue
+
+from .utils import get_config
+
+logger = logging.getLogger('netbox_ddns')
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BULK = 'bulk'
+
+
+def queue_name(priority: str) -> str:
+    return get_config(f'{priority}_queue')
+
+
+def get_queue(priority: str) -> Queue:
+    return django_rq.get_queue(queue_name(priority))
+
+
+def plugin_job(priority: str = PRIORITY_INTERACTIVE):
+    """
+    django_rq's job decorator for the queue of the given priority, keeping the results of the jobs queued with
+    delay() for result_ttl seconds
+    """
+    return job(queue_name(priority), result_ttl=get_config('result_ttl'))
+
+
+def enqueue_bulk(func, arguments: Iterable[tuple]) -> int:
+    """
+    Queue a bulk job for each set of arguments without flooding the bulk queue: as many as fit below
+    throttle_bulk_depth are queued right away, the others are scheduled in groups of throttle_bulk_depth jobs,
+    throttle_bulk_interval seconds apart. Returns the number of jobs.
+    """
+    arguments = list(arguments)
+    queue = get_queue(PRIORITY_BULK)
+    depth = get_config('throttle_bulk_depth')
+    interval = get_config('throttle_bulk_interval')
+
+    room = max(depth - queue.count, 0) if depth and arguments else len(arguments)
+    for index, args in enumerate(arguments):
+        if index < room:
+            func.delay(*args)
+        else:
+            group = (index - room) // depth + 1
+            queue.enqueue_in(timedelta(seconds=group * interval), func, *args, result_ttl=get_config('result_ttl'))
+
+    if len(arguments) > room:
+        logger.info(f"The bulk queue is full, scheduled {len(arguments) - room} of {len(arguments)} jobs for later")
+    return len(arguments)
@@ -0,0 +1,159 @@
+import logging
+import time
+from typing import List, Optional
+
+import django_rq
+import dns.rcode
+
+from .utils import get_config
+
+logger = logging.getLogger('netbox_ddns')
+
+# Responses that mean the server can't keep up, as opposed to answers about the records themselves
+OVERLOAD_RCODES = (dns.rcode.SERVFAIL, dns.rcode.REFUSED)
+
+# Only slow down once per this many seconds, all updates in flight when a server gets overloaded fail together
+DECREASE_INTERVAL = 1.0
+
+# The state of servers that haven't been updated for this many seconds is forgotten
+STATE_EXPIRY = 86400
+
+# Take tokens, going into debt when there aren't enough, and return how long to wait for them as a string
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local initial = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'rate', 'tokens', 'time')
+local rate = tonumber(state[1]) or initial
+local tokens = tonumber(state[2]) or burst
+local last = tonumber(state[3]) or now
+if now > last then
+    tokens = math.min(burst, tokens + (now - last) * rate)
+    last = now
+end
+tokens = tokens - tonumber(ARGV[5])
+redis.call('HSET', KEYS[1], 'rate', rate, 'tokens', tokens, 'time', last)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+# Adapt the rate: additive increase for every success, multiplicative decrease after overload. Returns the new rate
+# when it has been decreased.
+FEEDBACK_SCRIPT = """
+local now = tonumber(ARGV[1])
+local successes = tonumber(ARGV[2])
+local overloaded = tonumber(ARGV[3])
+local initial = tonumber(ARGV[4])
+local increase = tonumber(ARGV[5])
+local decrease = tonumber(ARGV[6])
+local min_rate = tonumber(ARGV[7])
+local max_rate = tonumber(ARGV[8])
+local interval = tonumber(ARGV[9])
+local state = redis.call('HMGET', KEYS[1], 'rate', 'decreased')
+local rate = tonumber(state[1]) or initial
+for i = 1, successes do
+    if rate >= max_rate then
+        break
+    end
+    rate = rate + increase / rate
+end
+local decreased = ''
+if overloaded == 1 and now - (tonumber(state[2]) or 0) >= interval then
+    rate = rate * decrease
+    redis.call('HSET', KEYS[1], 'decreased', now)
+    decreased = 'yes'
+end
+rate = math.max(min_rate, math.min(max_rate, rate))
+redis.call('HSET', KEYS[1], 'rate', rate)
+redis.call('EXPIRE', KEYS[1], ARGV[10])
+if decreased == '' then
+    return ''
+end
+return tostring(rate)
+"""
+
+
+class RateLimiter:
+    """
+    A token bucket per DDNS server, shared by all workers through Redis. The rate adapts to what the server can
+    handle: it increases by rate_increase per second while updates succeed, and is multiplied by rate_decrease
+    when the server answers SERVFAIL or REFUSED or doesn't answer at all.
+    """
+
+    def __init__(self):
+        self._connection = None
+        self._acquire = None
+        self._feedback = None
+
+    def _scripts(self):
+        if self._acquire is None:
+            self._connection = django_rq.get_connection()
+            self._acquire = self._connection.register_script(ACQUIRE_SCRIPT)
+            self._feedback = self._connection.register_script(FEEDBACK_SCRIPT)
+        return self._acquire, self._feedback
+
+    @staticmethod
+    def _key(server) -> str:
+        return f'netbox_ddns:rate:{server.pk}'
+
+    @staticmethod
+    def max_rate(server) -> float:
+        return server.max_rate or get_config('rate_max')
+
+    def _initial_rate(self, server) -> float:
+        return min(get_config('rate_initial'), self.max_rate(server))
+
+    def acquire(self, server, count: int = 1):
+        """
+        Wait until the server may receive another count messages
+        """
+        if not get_config('rate_limit') or server.pk is None or count < 1:
+            return
+
+        acquire, _ = self._scripts()
+        wait = float(acquire(keys=[self._key(server)], args=[
+            time.time(),
+            self._initial_rate(server),
+            get_config('rate_burst'),
+            STATE_EXPIRY,
+            count,
+        ]))
+        if wait > 0:
+            logger.debug(f"Waiting {wait:.3f}s before sending {count} messages to {server}")
+            time.sleep(wait)
+
+    def feedback(self, server, codes: List[Optional[int]]):
+        """
+        Adapt the rate to the response codes of a batch of updates, None for an update the server didn't respond to
+        """
+        if not get_config('rate_limit') or server.pk is None or not codes:
+            return
+
+        overloaded = any(code is None or code in OVERLOAD_RCODES for code in codes)
+        successes = sum(1 for code in codes if code is not None and code not in OVERLOAD_RCODES)
+        _, feedback = self._scripts()
+        rate = feedback(keys=[self._key(server)], args=[
+            time.time(),
+            successes,
+            1 if overloaded else 0,
+            self._initial_rate(server),
+            get_config('rate_increase'),
+            get_config('rate_decrease'),
+            get_config('rate_min'),
+            self.max_rate(server),
+            DECREASE_INTERVAL,
+            STATE_EXPIRY,
+        ])
+        if rate:
+            logger.warning(f"Slowing down updates to {server} to {float(rate):.1f} per second")
+
+    def current_rate(self, server) -> float:
+        self._scripts()
+        rate = self._connection.hget(self._key(server), 'rate')
+        return float(rate) if rate else self._initial_rate(server)
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,249 @@
+import logging
+from collections import Counter
+from typing import Iterator, List, Set, Tuple
+
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdatatype
+from netaddr import IPAddress as NetAddress
+
+from .background_tasks import dns_send_records
+from .batch import PendingRecord
+from .dispatcher import dispatch
+from .lookup import reverse_zone_index, zone_index
+from .metrics import metrics
+from .models import ACTION_CREATE, ACTION_DELETE, ReverseZone, Server, Zone
+from .payload import pack_records
+from .queues import PRIORITY_BULK, enqueue_bulk, plugin_job
+from .resync import KIND_FORWARD, forward_zone_addresses, forward_zone_extras, reverse_zone_addresses
+from .utils import get_config, get_soa, normalize_fqdn
+
+logger = logging.getLogger('netbox_ddns')
+
+# A record as (owner name, type, rdata), all in lower case text
+Record = Tuple[str, str, str]
+
+FORWARD_TYPES = ('A', 'AAAA')
+REVERSE_TYPES = ('PTR',)
+
+
+def _canonical_rdata(rdtype: str, rdata: str) -> str:
+    if rdtype in FORWARD_TYPES:
+        return str(NetAddress(rdata))
+    return normalize_fqdn(rdata)
+
+
+def fetch_records(server: Server, zone_name: str, rdtypes: Tuple[str, ...]) -> Set[Record]:
+    """
+    Transfer the zone from its server with AXFR and return the records of the given types. Glue records below
+    delegations are left out, because they don't belong to this zone.
+    """
+    keyring, keyname = server.get_keyring()
+    messages = dns.query.xfr(
+        server.address,
+        zone_name,
+        port=server.server_port,
+        keyring=keyring,
+        keyname=keyname,
+        keyalgorithm=server.tsig_algorithm,
+        relativize=False,
+        lifetime=get_config('axfr_timeout'),
+    )
+
+    origin = dns.name.from_text(zone_name)
+    wanted = {dns.rdatatype.from_text(rdtype) for rdtype in rdtypes}
+    records = set()
+    cuts = set()
+    for message in messages:
+        for rrset in message.answer:
+            if rrset.rdtype == dns.rdatatype.NS and rrset.name != origin:
+                cuts.add(rrset.name.to_text().lower())
+            elif rrset.rdtype in wanted:
+                rdtype = dns.rdatatype.to_text(rrset.rdtype)
+                for rdata in rrset:
+                    records.add((rrset.name.to_text().lower(), rdtype, _canonical_rdata(rdtype, rdata.to_text())))
+
+    if cuts:
+        records = {record for record in records if not _below_cut(record[0], cuts)}
+
+    return records
+
+
+def _below_cut(name: str, cuts: Set[str]) -> bool:
+    labels = name.split('.')
+    return any('.'.join(labels[i:]) in cuts for i in range(len(labels) - 1))
+
+
+def _address_record(name: str, address) -> Record:
+    ip = address.ip
+    return name, 'A' if ip.version == 4 else 'AAAA', str(ip)
+
+
+def desired_forward(zone: Zone) -> Iterator[Record]:
+    chunk_size = get_config('resync_chunk_size')
+
+    ip_addresses = forward_zone_addresses(zone).values_list('address', 'dns_name')
+    extra_names = forward_zone_extras(zone).values_list('ip_address__address', 'name')
+    for queryset in (ip_addresses, extra_names):
+        for address, dns_name in queryset.iterator(chunk_size=chunk_size):
+            name = normalize_fqdn(dns_name)
+            found = zone_index.find(name) if name else None
+            if found and found.pk == zone.pk:
+                yield _address_record(name, address)
+
+
+def _reverse_records(zone: ReverseZone, rows: List[Tuple[int, str]]) -> Iterator[Record]:
+    record_names = zone.record_names([value for value, name in rows])
+    for record_name, (value, name) in zip(record_names, rows):
+        yield record_name.lower(), 'PTR', name
+
+
+def desired_reverse(zone: ReverseZone) -> Iterator[Record]:
+    chunk_size = get_config('resync_chunk_size')
+
+    # The record names are generated per chunk
+    rows = []
+    ip_addresses = reverse_zone_addresses(zone).values_list('address', 'dns_name')
+    for address, dns_name in ip_addresses.iterator(chunk_size=chunk_size):
+        name = normalize_fqdn(dns_name)
+        found = reverse_zone_index.find(address.ip) if name else None
+        if found and found.pk == zone.pk:
+            rows.append((address.ip.value, name))
+            if len(rows) >= chunk_size:
+                yield from _reverse_records(zone, rows)
+                rows = []
+
+    yield from _reverse_records(zone, rows)
+
+
+class Reconciliation:
+    """
+    The difference between what NetBox wants in a zone and what the zone's server has
+    """
+
+    def __init__(self, zone: Zone | ReverseZone, kind: str):
+        self.zone = zone
+        self.kind = kind
+        self.adds: List[Record] = []
+        self.deletes: List[Record] = []
+        self.desired_count = 0
+        self.actual_count = 0
+        self.messages = 0
+        self.jobs = 0
+        self.rcodes = Counter()
+
+    def compute(self):
+        rdtypes = FORWARD_TYPES if self.kind == KIND_FORWARD else REVERSE_TYPES
+        desired = set(desired_forward(self.zone) if self.kind == KIND_FORWARD else desired_reverse(self.zone))
+        actual = fetch_records(self.zone.server, self.zone.name, rdtypes)
+        self.desired_count = len(desired)
+        self.actual_count = len(actual)
+
+        self.adds = sorted(desired - actual)
+
+        prune = get_config('reconcile_prune')
+        if prune == 'none':
+            self.deletes = []
+        elif prune == 'all':
+            self.deletes = sorted(actual - desired)
+        else:
+            # Only remove records for names that NetBox manages, a record that merely points to an address or name
+            # NetBox knows about may have been added by hand
+            names = {name for name, rdtype, rdata in desired}
+            self.deletes = sorted(record for record in actual - desired if record[0] in names)
+
+        return self
+
+    def _pending(self, action: int, record: Record) -> PendingRecord:
+        name, rdtype, rdata = record
+        verb = 'Adding' if action == ACTION_CREATE else 'Deleting'
+        return PendingRecord(
+            server=self.zone.server,
+            zone_name=self.zone.name,
+            action=action,
+            name=name,
+            ttl=self.zone.ttl,
+            rdtype=rdtype,
+            rdata=rdata,
+            status=None,
+            status_field='',
+            operation=f'{verb} {name} {rdtype} {rdata}',
+        )
+
+    def _records(self) -> List[PendingRecord]:
+        # Deletes first, they never touch the same record as an add
+        records = [self._pending(ACTION_DELETE, record) for record in self.deletes]
+        records += [self._pending(ACTION_CREATE, record) for record in self.adds]
+        return records
+
+    def apply(self):
+        """
+        Send the changes from this process, in chunks
+        """
+        records = self._records()
+        chunk_size = get_config('resync_chunk_size')
+        for start in range(0, len(records), chunk_size):
+            responses = {}
+            for record, response in dispatch(records[start:start + chunk_size]):
+                responses[id(response)] = response
+                self.rcodes[dns.rcode.to_text(response.rcode())] += 1
+                metrics.record_response(record.server, record.zone_name, response.rcode())
+                if response.rcode() != dns.rcode.NOERROR:
+                    logger.error(f"{record.operation} failed: {dns.rcode.to_text(response.rcode())}")
+
+            self.messages += len(responses)
+        return self
+
+    def enqueue(self):
+        """
+        Queue the changes as bulk jobs of one chunk each, so interactive jobs don't wait for all of them
+        """
+        records = self._records()
+        chunk_size = get_config('resync_chunk_size')
+        self.jobs = enqueue_bulk(dns_send_records, [(pack_records(records[start:start + chunk_size]),)
+                                                    for start in range(0, len(records), chunk_size)])
+        return self
+
+    def __str__(self):
+        summary = (f"{self.zone.name}: {self.desired_count} records in NetBox, {self.actual_count} on the server, "
+                   f"{len(self.adds)} to add, {len(self.deletes)} to delete")
+        if self.messages:
+            results = ', '.join(f'{count} {rcode}' for rcode, count in sorted(self.rcodes.items()))
+            summary += f", sent in {self.messages} messages ({results})"
+        if self.jobs:
+            summary += f", queued in {self.jobs} jobs"
+        return summary
+
+
+def reconcile_zone(zone: Zone | ReverseZone, kind: str, dry_run: bool = False, queue: bool = False) \
+        -> Reconciliation:
+    """
+    Compare the zone with its server and send the changes, or queue them as bulk jobs
+    """
+    # Check the SOA, we don't want to write to a parent zone if it has delegated authority
+    soa = get_soa(zone.name)
+    if soa != zone.name:
+        raise ValueError(f"Can't reconcile zone {zone.name}, it has delegated authority for {soa}")
+
+    reconciliation = Reconciliation(zone, kind).compute()
+    if queue and not dry_run:
+        reconciliation.enqueue()
+    elif not dry_run:
+        reconciliation.apply()
+
+    logger.info(str(reconciliation))
+    return reconciliation
+
+
+@plugin_job(PRIORITY_BULK)
+def dns_reconcile_zone(kind: str, zone_pk: int, dry_run: bool = False):
+    """
+    Transfer a zone from its server and queue only the changes needed to make it match NetBox
+    """
+    model = Zone if kind == KIND_FORWARD else ReverseZone
+    with metrics.measure_job('dns_reconcile_zone') as timings:
+        zone = model.objects.select_related('server').filter(pk=zone_pk).first()
+        output = str(reconcile_zone(zone, kind, dry_run=dry_run, queue=True)) if zone \
+            else f'Zone {zone_pk} no longer exists'
+    return timings.result(output)
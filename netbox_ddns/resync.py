@@ -0,0 +1,294 @@
+import json
+import logging
+from itertools import chain
+from typing import Dict, Iterator, List, Optional
+
+import django_rq
+from django.db.models import Q, QuerySet
+from rq import Retry, get_current_job
+from rq.job import Job
+
+from ipam.models import IPAddress
+from .background_tasks import BatchOperation, is_unchanged, plan_operations, run_operations
+from .metrics import metrics
+from .models import ACTION_CREATE, DNSStatus, ExtraDNSName, ReverseZone, Zone
+from .queues import PRIORITY_BULK, get_queue, plugin_job
+from .utils import get_config, normalize_fqdn
+from .writeback import status_writer
+
+logger = logging.getLogger('netbox_ddns')
+
+KIND_FORWARD = 'forward'
+KIND_REVERSE = 'reverse'
+
+# Checkpoints of interrupted resyncs are kept this many seconds
+CHECKPOINT_EXPIRY = 7 * 86400
+
+
+def forward_zone_addresses(zone: Zone) -> QuerySet:
+    # Find all more-specific zones
+    more_specifics = Zone.objects.filter(name__endswith=zone.name).exclude(pk=zone.pk)
+
+    # Find all IPAddress objects in this zone but not in the more-specifics
+    ip_addresses = IPAddress.objects.filter(Q(dns_name__endswith=zone.name) |
+                                            Q(dns_name__endswith=zone.name.rstrip('.')))
+    for more_specific in more_specifics:
+        ip_addresses = ip_addresses.exclude(Q(dns_name__endswith=more_specific.name) |
+                                            Q(dns_name__endswith=more_specific.name.rstrip('.')))
+
+    return ip_addresses
+
+
+def forward_zone_extras(zone: Zone) -> QuerySet:
+    # Find all ExtraDNSName objects in this zone but not in the more-specifics
+    more_specifics = Zone.objects.filter(name__endswith=zone.name).exclude(pk=zone.pk)
+
+    extra_names = ExtraDNSName.objects.filter(name__endswith=zone.name)
+    for more_specific in more_specifics:
+        extra_names = extra_names.exclude(name__endswith=more_specific.name)
+
+    return extra_names
+
+
+def reverse_zone_addresses(zone: ReverseZone) -> QuerySet:
+    # Find all more-specific zones
+    more_specifics = ReverseZone.objects.filter(prefix__net_contained=zone.prefix).exclude(pk=zone.pk)
+
+    # Find all IPAddress objects in this zone but not in the more-specifics
+    ip_addresses = IPAddress.objects.filter(address__net_contained_or_equal=zone.prefix)
+    for more_specific in more_specifics:
+        ip_addresses = ip_addresses.exclude(address__net_contained_or_equal=more_specific.prefix)
+
+    return ip_addresses
+
+
+def chunks(queryset: QuerySet, after: int = 0) -> Iterator[List]:
+    """
+    Walk through a queryset in primary key order, one chunk at a time, starting after the given primary key
+    """
+    chunk_size = get_config('resync_chunk_size')
+    while True:
+        chunk = list(queryset.filter(pk__gt=after).order_by('pk')[:chunk_size])
+        if not chunk:
+            return
+
+        yield chunk
+        after = chunk[-1].pk
+
+
+def get_statuses(ip_pks: List[int]) -> Dict[int, DNSStatus]:
+    """
+    Fetch the DNSStatus objects for many IP addresses, creating the ones that don't exist yet
+    """
+    DNSStatus.objects.bulk_create([DNSStatus(ip_address_id=pk) for pk in ip_pks], ignore_conflicts=True)
+    return {status.ip_address_id: status for status in DNSStatus.objects.filter(ip_address_id__in=ip_pks)}
+
+
+def _checkpoint_key(kind: str, zone_pk: int) -> str:
+    return f'netbox_ddns:resync:{kind}:{zone_pk}'
+
+
+class Progress:
+    """
+    Reports the progress of a resync in the job meta data, and keeps a checkpoint in Redis to resume from. Without
+    checkpoint, the resync always starts at the beginning and leaves the checkpoint of the resync job alone.
+    """
+
+    def __init__(self, kind: str, zone_pk: int, checkpoint: bool = True):
+        self.key = _checkpoint_key(kind, zone_pk) if checkpoint else None
+        self.connection = django_rq.get_connection()
+        self.job = get_current_job()
+
+        stored = self.connection.get(self.key) if self.key else None
+        self.state = json.loads(stored) if stored else {'phase': 'addresses', 'after': 0, 'done': 0}
+        if stored:
+            logger.info(f"Resuming resync from {self.state}")
+
+    def update(self, phase: str, after: int, count: int):
+        # Don't skip records on resume whose results haven't been saved
+        status_writer.flush()
+
+        self.state = {'phase': phase, 'after': after, 'done': self.state['done'] + count}
+        if self.key:
+            self.connection.set(self.key, json.dumps(self.state), ex=CHECKPOINT_EXPIRY)
+        if self.job:
+            self.job.meta['progress'] = self.state
+            self.job.save_meta()
+
+    def finish(self):
+        if self.key:
+            self.connection.delete(self.key)
+
+
+def _resync_addresses(ip_addresses: QuerySet, progress: Progress, forward: bool, reverse: bool, force: bool) \
+        -> Iterator[None]:
+    if progress.state['phase'] != 'addresses':
+        return
+
+    ip_addresses = ip_addresses.only('pk', 'address', 'dns_name')
+    for chunk in chunks(ip_addresses, after=progress.state['after']):
+        named = [ip_address for ip_address in chunk if ip_address.dns_name]
+        statuses = get_statuses([ip_address.pk for ip_address in named])
+
+        run_operations([
+            (ACTION_CREATE, normalize_fqdn(ip_address.dns_name), ip_address.address.ip, forward, reverse,
+             statuses.get(ip_address.pk))
+            for ip_address in named
+        ], force=force)
+        progress.update('addresses', chunk[-1].pk, len(named))
+        yield
+
+    progress.update('extras', 0, 0)
+
+
+def _resync_extras(extra_names: QuerySet, progress: Progress, force: bool) -> Iterator[None]:
+    extra_names = extra_names.select_related('ip_address')
+    for chunk in chunks(extra_names, after=progress.state['after']):
+        run_operations([
+            (ACTION_CREATE, extra.name, extra.ip_address.address.ip, True, False, extra)
+            for extra in chunk
+        ], force=force)
+        progress.update('extras', chunk[-1].pk, len(chunk))
+        yield
+
+
+def resync_zone(kind: str, zone: Zone | ReverseZone, progress: Progress, force: bool = False,
+                max_chunks: Optional[int] = None) -> bool:
+    """
+    Send the records of a zone, continuing from the checkpoint of the progress, stopping after max_chunks chunks.
+    Records that haven't changed since they were added are skipped unless forced. Returns whether all records have
+    been sent.
+    """
+    if kind == KIND_FORWARD:
+        steps = chain(_resync_addresses(forward_zone_addresses(zone), progress, forward=True, reverse=False,
+                                        force=force),
+                      _resync_extras(forward_zone_extras(zone), progress, force=force))
+    else:
+        steps = _resync_addresses(reverse_zone_addresses(zone), progress, forward=False, reverse=True, force=force)
+
+    # Results are written in bulk, at the latest when a checkpoint is stored
+    with status_writer.batch():
+        for count, _ in enumerate(steps, start=1):
+            if max_chunks and count >= max_chunks:
+                return False
+
+    return True
+
+
+def _planned_operations(kind: str, zone: Zone | ReverseZone) -> Iterator[List[BatchOperation]]:
+    """
+    The operations of a resync of the zone, one chunk at a time, with the existing statuses but without creating any
+    """
+    forward = kind == KIND_FORWARD
+    ip_addresses = forward_zone_addresses(zone) if forward else reverse_zone_addresses(zone)
+    for chunk in chunks(ip_addresses.exclude(dns_name='').only('pk', 'address', 'dns_name')):
+        statuses = {status.ip_address_id: status
+                    for status in DNSStatus.objects.filter(ip_address_id__in=[ip_address.pk for ip_address in chunk])}
+        yield [
+            (ACTION_CREATE, normalize_fqdn(ip_address.dns_name), ip_address.address.ip, forward, not forward,
+             statuses.get(ip_address.pk))
+            for ip_address in chunk
+        ]
+
+    if forward:
+        for chunk in chunks(forward_zone_extras(zone).select_related('ip_address')):
+            yield [(ACTION_CREATE, extra.name, extra.ip_address.address.ip, True, False, extra) for extra in chunk]
+
+
+def count_records(kind: str, zone: Zone | ReverseZone, force: bool = False) -> int:
+    """
+    The number of records a resync of the zone would send. Unless forced, the records are planned like a resync does,
+    so the ones that would be skipped as unchanged aren't counted.
+    """
+    if force or not get_config('skip_unchanged'):
+        if kind == KIND_FORWARD:
+            return forward_zone_addresses(zone).exclude(dns_name='').count() + forward_zone_extras(zone).count()
+        return reverse_zone_addresses(zone).exclude(dns_name='').count()
+
+    return sum(
+        sum(1 for record in plan_operations(operations) if not is_unchanged(record))
+        for operations in _planned_operations(kind, zone)
+    )
+
+
+@plugin_job(PRIORITY_BULK)
+def dns_resync_zone(kind: str, zone_pk: int, force: bool = False):
+    """
+    Send the next chunk of records of a zone, continuing from the checkpoint, and queue a job for the chunk after
+    it. Every chunk is a separate job at the back of the bulk queue, so interactive jobs that were queued in the
+    meantime go first.
+    """
+    lock = zone_lock(kind, zone_pk)
+    if not lock.acquire(blocking=False):
+        return f'All records of {kind} zone {zone_pk} are already being updated'
+
+    try:
+        progress = Progress(kind, zone_pk)
+
+        with metrics.measure_job('dns_resync_zone') as timings:
+            model = Zone if kind == KIND_FORWARD else ReverseZone
+            zone = model.objects.filter(pk=zone_pk).first()
+            finished = not zone or resync_zone(kind, zone, progress, force=force, max_chunks=1)
+
+            done = progress.state['done']
+            if finished:
+                progress.finish()
+    finally:
+        lock.release()
+
+    if not zone:
+        django_rq.get_connection().delete(_active_key(kind, zone_pk))
+        return timings.result(f'Zone {zone_pk} no longer exists')
+
+    if not finished:
+        # Only after releasing the lock, another worker may pick it up right away
+        _enqueue_chunk(kind, zone_pk, force)
+        return timings.result(f'Processed {done} {kind} records in {zone.name} so far')
+
+    django_rq.get_connection().delete(_active_key(kind, zone_pk))
+    return timings.result(f'Processed {done} {kind} records in {zone.name}')
+
+
+def zone_lock(kind: str, zone_pk: int):
+    """
+    Held while records of a zone are being sent, by a resync job or by ddns_sync
+    """
+    return django_rq.get_connection().lock(_checkpoint_key(kind, zone_pk) + ':lock',
+                                           timeout=get_config('resync_job_timeout'))
+
+
+def _active_key(kind: str, zone_pk: int) -> str:
+    return _checkpoint_key(kind, zone_pk) + ':active'
+
+
+def resync_pending(kind: str, zone_pk: int) -> bool:
+    """
+    Whether a resync of the zone is in progress, it is considered stalled when none of its chunks finished for
+    resync_job_timeout seconds
+    """
+    return bool(django_rq.get_connection().exists(_active_key(kind, zone_pk)))
+
+
+def _enqueue_chunk(kind: str, zone_pk: int, force: bool) -> Job:
+    django_rq.get_connection().expire(_active_key(kind, zone_pk), get_config('resync_job_timeout'))
+    return get_queue(PRIORITY_BULK).enqueue(
+        dns_resync_zone,
+        kind,
+        zone_pk,
+        force,
+        job_timeout=get_config('resync_job_timeout'),
+        result_ttl=get_config('result_ttl'),
+        retry=Retry(max=get_config('resync_retries')),
+    )
+
+
+def enqueue_resync(kind: str, zone_pk: int, force: bool = False) -> Optional[Job]:
+    """
+    Queue a resync of a zone, unless one is already in progress. A resync that stalled, for example because its job
+    kept failing, continues from its checkpoint.
+    """
+    if not django_rq.get_connection().set(_active_key(kind, zone_pk), 1, nx=True,
+                                          ex=get_config('resync_job_timeout')):
+        return None
+
+    return _enqueue_chunk(kind, zone_pk, force)
@@ -1,131 +1,186 @@
 import logging
-from django.db.models.signals import post_delete, post_save, pre_save
+from typing import Optional, Tuple
+
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
 from django.dispatch import receiver
-from netaddr import IPNetwork
+from netaddr import IPAddress as NetAddress, IPNetwork
 
 from ipam.models import IPAddress
-from netbox_ddns.background_tasks import dns_create, dns_delete
-from netbox_ddns.models import DNSStatus, ExtraDNSName
+from netbox_ddns.coalesce import KIND_EXTRA, KIND_IPADDRESS, collector
+from netbox_ddns.lookup import reverse_zone_index, zone_index
+from netbox_ddns.models import ExtraDNSName, ReverseZone, Server, Zone
 from netbox_ddns.utils import normalize_fqdn
 
 logger = logging.getLogger('netbox_ddns')
 
 
+def _ipaddress_state(address, dns_name: str) -> Tuple[Optional[NetAddress], str]:
+    if isinstance(address, str):
+        address = IPNetwork(address)
+    return (address.ip if address else None), normalize_fqdn(dns_name)
+
+
+@receiver(post_init, sender=IPAddress)
+def track_ipaddress(instance: IPAddress, **_kwargs):
+    # Remember the DNS relevant fields as loaded from the database, without touching deferred fields
+    address = instance.__dict__.get('address')
+    if instance.pk is not None and isinstance(address, IPNetwork) and 'dns_name' in instance.__dict__:
+        instance._ddns_loaded = (address.value, address.version, instance.dns_name)
+
+
+def _original_ipaddress(instance: IPAddress) -> Optional[Tuple[Optional[NetAddress], str]]:
+    loaded = getattr(instance, '_ddns_loaded', None)
+    if loaded and not instance._state.adding:
+        value, version, dns_name = loaded
+        return NetAddress(value, version), normalize_fqdn(dns_name)
+
+    snapshot = getattr(instance, '_prechange_snapshot', None)
+    if snapshot and 'address' in snapshot and 'dns_name' in snapshot:
+        return _ipaddress_state(snapshot['address'], snapshot['dns_name'])
+
+    if instance.pk is None:
+        return None
+
+    # No snapshot available, ask the database
+    original = IPAddress.objects.filter(pk=instance.pk).values_list('address', 'dns_name').first()
+    return _ipaddress_state(*original) if original else None
+
+
 @receiver(pre_save, sender=IPAddress)
-def store_original_ipaddress(instance: IPAddress, **_kwargs):
-    instance.before_save = IPAddress.objects.filter(pk=instance.pk).first()
+def store_original_ipaddress(instance: IPAddress, update_fields=None, **_kwargs):
+    if update_fields is not None and not {'address', 'dns_name'} & set(update_fields):
+        instance._ddns_original = False
+        return
+
+    instance._ddns_original = _original_ipaddress(instance)
 
 
 @receiver(post_save, sender=IPAddress)
 def trigger_ddns_update(instance: IPAddress, **_kwargs):
-    old_address = instance.before_save.address.ip if instance.before_save else None
-    old_dns_name = normalize_fqdn(instance.before_save.dns_name) if instance.before_save else ''
-
-    new_address = IPNetwork(instance.address).ip
-    new_dns_name = normalize_fqdn(instance.dns_name)
+    original = getattr(instance, '_ddns_original', None)
+    if original is False:
+        # None of the DNS relevant fields were saved
+        return
 
-    extra_dns_names = {normalize_fqdn(extra.name): extra for extra in instance.extradnsname_set.all()}
+    old_address, old_dns_name = original or (None, '')
+    new_address, new_dns_name = _ipaddress_state(instance.address, instance.dns_name)
 
     if new_address != old_address or new_dns_name != old_dns_name:
-        status, created = DNSStatus.objects.get_or_create(ip_address=instance)
-
-        if old_address and old_dns_name and old_dns_name not in extra_dns_names:
-            delete = dns_delete.delay(
-                dns_name=old_dns_name,
-                address=old_address,
-                status=status,
-            )
-        else:
-            delete = None
-
-        if new_address and new_dns_name:
-            dns_create.delay(
-                dns_name=new_dns_name,
-                address=new_address,
-                status=status,
-                depends_on=delete,
-            )
-
-    if old_address != new_address:
-        # This affects extra names
-        for dns_name, status in extra_dns_names.items():
-            # Don't touch the main dns_name
-            if dns_name == old_dns_name or dns_name == new_dns_name:
-                continue
-
-            if old_dns_name:
-                delete = dns_delete.delay(
-                    dns_name=dns_name,
-                    address=old_address,
-                    reverse=False,
-                    status=status,
-                )
-            else:
-                delete = None
-
-            if new_dns_name:
-                dns_create.delay(
-                    dns_name=dns_name,
-                    address=new_address,
-                    reverse=False,
-                    status=status,
-                    depends_on=delete,
-                )
+        collector.add(
+            KIND_IPADDRESS,
+            instance.pk,
+            old={'address': str(old_address) if old_address else None, 'dns_name': old_dns_name},
+            new={'address': str(new_address), 'dns_name': new_dns_name},
+        )
+
+    # The saved state is the starting point for the next save of this instance
+    address = IPNetwork(instance.address)
+    instance._ddns_loaded = (address.value, address.version, instance.dns_name)
 
 
 @receiver(post_delete, sender=IPAddress)
 def trigger_ddns_delete(instance: IPAddress, **_kwargs):
     old_address = instance.address.ip
     old_dns_name = normalize_fqdn(instance.dns_name)
+    if not old_dns_name:
+        # Nothing in DNS to delete, and a pending change already has an empty name as its new state
+        return
+
+    collector.add(
+        KIND_IPADDRESS,
+        instance.pk,
+        old={'address': str(old_address), 'dns_name': old_dns_name},
+        new=None,
+    )
 
-    if old_address and old_dns_name:
-        dns_delete.delay(
-            address=old_address,
-            dns_name=old_dns_name,
-        )
+
+@receiver(post_init, sender=ExtraDNSName)
+def track_extra(instance: ExtraDNSName, **_kwargs):
+    if instance.pk is not None and 'name' in instance.__dict__:
+        instance._ddns_loaded = instance.name
+
+
+def _original_extra(instance: ExtraDNSName) -> Optional[str]:
+    loaded = getattr(instance, '_ddns_loaded', None)
+    if loaded is not None and not instance._state.adding:
+        return loaded
+
+    snapshot = getattr(instance, '_prechange_snapshot', None)
+    if snapshot and 'name' in snapshot:
+        return snapshot['name']
+
+    if instance.pk is None:
+        return None
+
+    # No snapshot available, ask the database
+    return ExtraDNSName.objects.filter(pk=instance.pk).values_list('name', flat=True).first()
 
 
 @receiver(pre_save, sender=ExtraDNSName)
-def store_original_extra(instance: ExtraDNSName, **_kwargs):
-    instance.before_save = ExtraDNSName.objects.filter(pk=instance.pk).first()
+def store_original_extra(instance: ExtraDNSName, update_fields=None, **_kwargs):
+    if update_fields is not None and 'name' not in update_fields:
+        instance._ddns_original = False
+        return
+
+    instance._ddns_original = _original_extra(instance)
 
 
 @receiver(post_save, sender=ExtraDNSName)
 def trigger_extra_ddns_update(instance: ExtraDNSName, **_kwargs):
-    address = instance.ip_address.address.ip
-    old_dns_name = instance.before_save.name if instance.before_save else ''
+    original = getattr(instance, '_ddns_original', None)
+    if original is False:
+        # The name wasn't saved
+        return
+
+    old_dns_name = original or ''
     new_dns_name = instance.name
 
     if new_dns_name != old_dns_name:
-        if old_dns_name:
-            delete = dns_delete.delay(
-                dns_name=old_dns_name,
-                address=address,
-                reverse=False,
-                status=instance,
-            )
-        else:
-            delete = None
-
-        dns_create.delay(
-            dns_name=new_dns_name,
-            address=address,
-            status=instance,
-            reverse=False,
-            depends_on=delete,
+        address = str(instance.ip_address.address.ip)
+        collector.add(
+            KIND_EXTRA,
+            instance.pk,
+            old={'ip_address': instance.ip_address_id, 'address': address, 'name': old_dns_name},
+            new={'ip_address': instance.ip_address_id, 'address': address, 'name': new_dns_name},
         )
 
+    instance._ddns_loaded = new_dns_name
+
 
 @receiver(post_delete, sender=ExtraDNSName)
 def trigger_extra_ddns_delete(instance: ExtraDNSName, **_kwargs):
-    address = instance.ip_address.address.ip
+    ip_address = instance.ip_address
+    address = str(ip_address.address.ip)
     old_dns_name = instance.name
 
-    if old_dns_name == normalize_fqdn(instance.ip_address.dns_name):
-        return
-
-    dns_delete.delay(
-        dns_name=old_dns_name,
-        address=address,
-        reverse=False,
+    # When the IP address is deleted too, extra names are deleted before it and it's gone by the time the change is
+    # applied, so remember its name here
+    collector.add(
+        KIND_EXTRA,
+        instance.pk,
+        old={'ip_address': ip_address.pk, 'address': address, 'name': old_dns_name,
+             'main_dns_name': normalize_fqdn(ip_address.dns_name)},
+        new=None,
     )
+
+
+@receiver(post_save, sender=Zone)
+@receiver(post_delete, sender=Zone)
+@receiver(post_save, sender=Server)
+@receiver(post_delete, sender=Server)
+def invalidate_zone_index(**_kwargs):
+    zone_index.invalidate()
+
+
+@receiver(post_save, sender=ReverseZone)
+@receiver(post_delete, sender=ReverseZone)
+@receiver(post_save, sender=Server)
+@receiver(post_delete, sender=Server)
+def invalidate_reverse_zone_index(**_kwargs):
+    reverse_zone_index.invalidate()
+
+
+@receiver(post_save, sender=Server)
+@receiver(post_delete, sender=Server)
+def invalidate_server_keyring(instance: Server, **_kwargs):
+    instance.forget_keyring()
@@ -0,0 +1,98 @@
+import logging
+import multiprocessing
+import time
+from typing import Iterable, Iterator, Tuple
+
+from django.db import connections
+
+from . import dispatcher
+from .metrics import metrics
+from .models import ReverseZone, Zone
+from .reconcile import reconcile_zone
+from .resync import KIND_FORWARD, Progress, count_records, resync_pending, resync_zone, zone_lock
+
+logger = logging.getLogger('netbox_ddns')
+
+# Send all records again, like the "update all records" admin action
+MODE_PUSH = 'push'
+
+# Transfer the zone from its server and only send the differences
+MODE_RECONCILE = 'reconcile'
+
+# Apply the changes from the NetBox change log since the previous run, see changelog.py
+MODE_INCREMENTAL = 'incremental'
+
+# (kind, zone primary key, mode, dry run, force)
+SyncTask = Tuple[str, int, str, bool, bool]
+
+
+def sync_zone(task: SyncTask) -> dict:
+    """
+    Synchronise one zone and return a summary. Errors are reported in the summary, so one broken zone doesn't stop
+    the others.
+    """
+    kind, zone_pk, mode, dry_run, force = task
+    start = time.monotonic()
+
+    model = Zone if kind == KIND_FORWARD else ReverseZone
+    zone = model.objects.select_related('server').filter(pk=zone_pk).first()
+    result = {
+        'kind': kind,
+        'zone': zone.name if zone else str(zone_pk),
+    }
+
+    try:
+        if not zone:
+            result['error'] = 'Zone no longer exists'
+        elif mode == MODE_RECONCILE:
+            with metrics.measure_job('ddns_sync'):
+                reconciliation = reconcile_zone(zone, kind, dry_run=dry_run)
+            result.update({
+                'adds': len(reconciliation.adds),
+                'deletes': len(reconciliation.deletes),
+                'messages': reconciliation.messages,
+            })
+        elif dry_run:
+            result['records'] = count_records(kind, zone, force=force)
+        else:
+            lock = zone_lock(kind, zone_pk)
+            if resync_pending(kind, zone_pk) or not lock.acquire(blocking=False):
+                result['error'] = 'All records of this zone are already being updated'
+            else:
+                try:
+                    # Always from the start, a checkpoint belongs to the background job
+                    progress = Progress(kind, zone_pk, checkpoint=False)
+                    with metrics.measure_job('ddns_sync'):
+                        resync_zone(kind, zone, progress, force=force)
+                    result['records'] = progress.state['done']
+                finally:
+                    lock.release()
+    except Exception as e:
+        logger.exception(f"Synchronising {result['zone']} failed")
+        result['error'] = str(e)
+
+    result['seconds'] = time.monotonic() - start
+    return result
+
+
+def _init_worker():
+    # Threads don't survive a fork, make sure the child starts its own
+    dispatcher._executor = None
+
+
+def run_pool(tasks: Iterable[SyncTask], workers: int) -> Iterator[dict]:
+    """
+    Synchronise the zones in a pool of processes, yielding the summaries as the zones finish
+    """
+    tasks = list(tasks)
+    if workers <= 1:
+        for task in tasks:
+            yield sync_zone(task)
+        return
+
+    # The children must open their own database connections instead of sharing the parent's
+    connections.close_all()
+
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes=min(workers, len(tasks)) or 1, initializer=_init_worker) as pool:
+        yield from pool.imap_unordered(sync_zone, tasks)
@@ -0,0 +1,241 @@
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import dns.exception
+import dns.flags
+import dns.inet
+import dns.message
+import dns.query
+import dns.update
+
+from .address_cache import server_addresses
+from .metrics import metrics
+from .models import Server
+from .ratelimit import rate_limiter
+from .utils import get_config
+
+logger = logging.getLogger('netbox_ddns')
+
+
+class Connection:
+    """
+    A TCP connection to a DDNS server that sends and receives length-prefixed DNS messages
+    """
+
+    def __init__(self, address: str, port: int, timeout: float):
+        self.key = (address, port)
+        self.sock = socket.create_connection((address, port), timeout=timeout)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def send(self, wire: bytes):
+        self.sock.sendall(struct.pack('!H', len(wire)) + wire)
+
+    def _read(self, length: int) -> bytes:
+        data = b''
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise EOFError('Connection closed by DDNS server')
+            data += chunk
+        return data
+
+    def receive(self) -> bytes:
+        length, = struct.unpack('!H', self._read(2))
+        return self._read(length)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    """
+    Keeps TCP connections to DDNS servers open between updates
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle: Dict[Tuple[str, int], List[Connection]] = {}
+
+    def acquire(self, address: str, port: int, timeout: float) -> Connection:
+        now = time.monotonic()
+        idle_timeout = get_config('tcp_idle_timeout')
+        with self._lock:
+            connections = self._idle.get((address, port), [])
+            while connections:
+                connection = connections.pop()
+                if now - connection.last_used < idle_timeout:
+                    connection.reused = True
+                    connection.sock.settimeout(timeout)
+                    return connection
+
+                # The server has probably closed it already
+                connection.close()
+
+        return Connection(address, port, timeout)
+
+    def release(self, connection: Connection):
+        connection.last_used = time.monotonic()
+        with self._lock:
+            self._idle.setdefault(connection.key, []).append(connection)
+
+
+pool = ConnectionPool()
+
+
+def _pipeline(server: Server, connection: Connection, updates: Sequence[dns.update.Update],
+              responses: List[Optional[dns.message.Message]], codes: List[Optional[int]], timeout: float):
+    """
+    Send the updates from the first one without a response onward over one connection, in order, with up to
+    pipeline_depth of them outstanding at the same time and within the rate limit of the server, and match the
+    responses by message id. Tokens of the rate limit are taken for a group of messages at once, whenever half of the
+    pipeline is free.
+    """
+    depth = get_config('pipeline_depth')
+
+    # Later updates may have been answered already, they are sent again so the server applies them in order
+    first = next(index for index, response in enumerate(responses) if response is None)
+    queue = list(range(first, len(updates)))
+    outstanding: Dict[int, Tuple[int, float]] = {}
+
+    while queue or outstanding:
+        if queue and len(outstanding) <= depth // 2:
+            group = queue[:depth - len(outstanding)]
+            del queue[:len(group)]
+
+            with metrics.phase('rate_wait', server):
+                rate_limiter.acquire(server, len(group))
+
+            for index in group:
+                update = updates[index]
+                while update.id in outstanding:
+                    update.id = random.randint(0, 65535)
+
+                wire = update.to_wire()
+                connection.send(wire)
+                metrics.record_sent(server, len(wire))
+                outstanding[update.id] = (index, time.monotonic())
+
+        try:
+            wire = connection.receive()
+        except socket.timeout:
+            server_addresses.record_rtt(connection.key[0], timeout)
+            raise dns.exception.Timeout(timeout=timeout)
+
+        if len(wire) < 2:
+            raise dns.exception.FormError('Short response from DDNS server')
+
+        message_id, = struct.unpack('!H', wire[:2])
+        if message_id not in outstanding:
+            raise dns.exception.FormError(f'Unexpected response id {message_id} from DDNS server')
+
+        index, sent = outstanding[message_id]
+        update = updates[index]
+        response = dns.message.from_wire(wire, keyring=update.keyring, request_mac=update.mac)
+        if not update.is_response(response):
+            raise dns.exception.FormError(f'Response id {message_id} from DDNS server does not match its update')
+
+        del outstanding[message_id]
+        rtt = time.monotonic() - sent
+        server_addresses.record_rtt(connection.key[0], rtt)
+        metrics.add_phase('round_trip', rtt, server)
+        responses[index] = response
+        codes.append(response.rcode())
+
+
+def _send_tcp(server: Server, updates: Sequence[dns.update.Update], codes: List[Optional[int]]) \
+        -> List[dns.message.Message]:
+    timeout = get_config('update_timeout')
+    with metrics.phase('address', server):
+        address = server.address
+    responses: List[Optional[dns.message.Message]] = [None] * len(updates)
+
+    while True:
+        connection = pool.acquire(address, server.server_port, timeout)
+        try:
+            _pipeline(server, connection, updates, responses, codes, timeout)
+        except (OSError, EOFError) as e:
+            connection.close()
+            if not connection.reused:
+                raise
+
+            # A pooled connection went stale, try again on a fresh one from the first update without a response.
+            # Sending updates twice is harmless because adds and deletes are idempotent.
+            logger.debug(f"Pooled connection to {server} failed ({e}), reconnecting")
+            continue
+        except Exception:
+            connection.close()
+            raise
+
+        pool.release(connection)
+        return responses
+
+
+def _send_udp(server: Server, update: dns.update.Update, codes: List[Optional[int]]) -> dns.message.Message:
+    timeout = get_config('update_timeout')
+    with metrics.phase('address', server):
+        address = server.address
+    with metrics.phase('rate_wait', server):
+        rate_limiter.acquire(server)
+
+    # Rendered and signed once, the response is checked against the MAC of this rendering
+    wire = update.to_wire()
+    metrics.record_sent(server, len(wire))
+    destination = (address, server.server_port)
+    expiration = time.time() + timeout
+    start = time.monotonic()
+    with socket.socket(dns.inet.af_for_address(address), socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        try:
+            dns.query.send_udp(sock, wire, destination, expiration)
+            response, _ = dns.query.receive_udp(sock, destination, expiration, keyring=update.keyring,
+                                                request_mac=update.mac)
+        except dns.exception.Timeout:
+            server_addresses.record_rtt(address, timeout)
+            raise
+    rtt = time.monotonic() - start
+    server_addresses.record_rtt(address, rtt)
+    metrics.add_phase('round_trip', rtt, server)
+
+    if not update.is_response(response):
+        raise dns.query.BadResponse
+
+    if response.flags & dns.flags.TC:
+        logger.debug(f"Truncated response from {server}, retrying over TCP")
+        return _send_tcp(server, [update], codes)[0]
+
+    codes.append(response.rcode())
+    return response
+
+
+def send_updates(server: Server, updates: Sequence[dns.update.Update], tcp: bool = False) \
+        -> List[dns.message.Message]:
+    """
+    Send UPDATE messages to a server and return their responses in the same order. With the TCP transport all
+    messages share one pooled connection and are pipelined. The rate limit of the server hears about the responses
+    once, when all have been received or the server stopped answering.
+    """
+    if not updates:
+        return []
+
+    codes: List[Optional[int]] = []
+    try:
+        if tcp or get_config('transport') == 'tcp':
+            return _send_tcp(server, updates, codes)
+
+        return [_send_udp(server, update, codes) for update in updates]
+    except (dns.exception.Timeout, OSError, EOFError):
+        codes.append(None)
+        raise
+    finally:
+        rate_limiter.feedback(server, codes)
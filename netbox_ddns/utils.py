@@ -1,5 +1,13 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
 import dns.rdatatype
 import dns.resolver
+from django.core.cache import cache
+
+logger = logging.getLogger('netbox_ddns')
 
 
 def normalize_fqdn(dns_name: str) -> str:
@@ -9,20 +17,138 @@ def normalize_fqdn(dns_name: str) -> str:
     return dns_name.lower().rstrip('.') + '.'
 
 
+def get_config(name: str):
+    from netbox.plugins import get_plugin_config
+
+    return get_plugin_config('netbox_ddns', name)
+
+
+class SharedIndex:
+    """
+    A per-process index that is rebuilt when it is invalidated. Invalidation bumps a generation counter in the
+    shared Django cache so that other processes (web workers, RQ workers) notice it too.
+    """
+    cache_key = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._generation = None
+        self._checked = 0.0
+
+    def build(self):
+        raise NotImplementedError
+
+    def _shared_generation(self) -> Optional[int]:
+        try:
+            return cache.get(self.cache_key, 0)
+        except Exception as e:
+            logger.warning(f"Can't read {self.cache_key} from the cache: {e}")
+            return None
+
+    def get(self):
+        now = time.monotonic()
+        if self._index is not None and now - self._checked < get_config('cache_check_interval'):
+            return self._index
+
+        with self._lock:
+            generation = self._shared_generation()
+            if self._index is None or generation is None or generation != self._generation:
+                self._index = self.build()
+                self._generation = generation
+
+            self._checked = now
+            return self._index
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+        try:
+            if not cache.add(self.cache_key, 1, timeout=None):
+                cache.incr(self.cache_key)
+        except Exception as e:
+            logger.warning(f"Can't bump {self.cache_key} in the cache: {e}")
+
+
+class DelegationCache(SharedIndex):
+    """
+    Remembers for each name that get_soa looked at where its zone cut is, for as long as the SOA TTL (or the negative
+    caching TTL for names without a SOA) allows.
+    """
+    cache_key = 'netbox_ddns:delegation_cache:generation'
+
+    def build(self) -> Dict[str, Tuple[float, str]]:
+        return {}
+
+    def lookup(self, zone_name: str) -> Optional[str]:
+        """
+        Returns the cached zone cut for this name, an empty string if the name is known to have no SOA of its own,
+        or None if nothing valid is cached.
+        """
+        # The metrics module imports the models, which import this module
+        from .metrics import metrics
+
+        entry = self.get().get(zone_name)
+        if entry and entry[0] > time.monotonic():
+            metrics.inc('netbox_ddns_delegation_cache_lookups_total', result='hit')
+            return entry[1]
+
+        metrics.inc('netbox_ddns_delegation_cache_lookups_total', result='miss')
+        return None
+
+    def store(self, zone_name: str, cut: str, ttl: Optional[int]):
+        if ttl is None:
+            ttl = get_config('soa_cache_negative_ttl')
+        ttl = min(ttl, get_config('soa_cache_max_ttl'))
+        if ttl > 0:
+            self.get()[zone_name] = (time.monotonic() + ttl, cut)
+
+    def flush(self):
+        """
+        Forget all zone cuts in all processes, for example after a zone has been re-delegated
+        """
+        self.invalidate()
+
+
+delegation_cache = DelegationCache()
+
+
+def _negative_ttl(response) -> Optional[int]:
+    for rrset in response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA:
+            return min(rrset.ttl, rrset[0].minimum)
+
+
+def _find_zone_cut(zone_name: str) -> Tuple[str, Optional[int]]:
+    try:
+        answer = dns.resolver.query(zone_name, dns.rdatatype.SOA)
+        return zone_name, answer.rrset.ttl
+    except dns.resolver.NoAnswer as e:
+        # The name exists, but has no SOA. Continue one level further up
+        return '', _negative_ttl(e.response())
+    except dns.resolver.NXDOMAIN as e:
+        # Look for a SOA record in the authority section
+        for query, response in e.responses().items():
+            for rrset in response.authority:
+                if rrset.rdtype == dns.rdatatype.SOA:
+                    return rrset.name.to_text(), _negative_ttl(response)
+
+        return '', None
+
+
 def get_soa(dns_name: str) -> str:
+    use_cache = get_config('soa_cache')
+
     parts = dns_name.rstrip('.').split('.')
     for i in range(len(parts)):
         zone_name = normalize_fqdn('.'.join(parts[i:]))
 
-        try:
-            dns.resolver.query(zone_name, dns.rdatatype.SOA)
-            return zone_name
-        except dns.resolver.NoAnswer:
-            # The name exists, but has no SOA. Continue one level further up
-            continue
-        except dns.resolver.NXDOMAIN as e:
-            # Look for a SOA record in the authority section
-            for query, response in e.responses().items():
-                for rrset in response.authority:
-                    if rrset.rdtype == dns.rdatatype.SOA:
-                        return rrset.name.to_text()
+        cut = delegation_cache.lookup(zone_name) if use_cache else None
+        if cut is None:
+            cut, ttl = _find_zone_cut(zone_name)
+            if use_cache:
+                delegation_cache.store(zone_name, cut, ttl)
+
+        if cut:
+            return cut
@@ -9,7 +9,8 @@ from django.views import View
 from ipam.models import IPAddress
 from netbox_ddns.background_tasks import dns_create
 from netbox_ddns.forms import ExtraDNSNameEditForm
-from netbox_ddns.models import DNSStatus, ExtraDNSName
+from netbox_ddns.models import ExtraDNSName
+from netbox_ddns.payload import STATUS_IPADDRESS, pack_address, status_ref
 from netbox_ddns.utils import normalize_fqdn
 
 from utilities.forms import ConfirmationForm
@@ -123,15 +124,18 @@ class IPAddressDNSNameRecreateView(PermissionRequiredMixin, View):
         new_address = ip_address.address.ip
         new_dns_name = normalize_fqdn(ip_address.dns_name)
 
+        # Without force, records that were already added exactly like this are skipped, so clicking again is cheap
+        force = bool(request.POST.get('force'))
+
         updated_names = []
 
         if new_dns_name:
-            status, created = DNSStatus.objects.get_or_create(ip_address=ip_address)
-
+            # The worker creates the DNS status if needed
             dns_create.delay(
                 dns_name=new_dns_name,
-                address=new_address,
-                status=status,
+                address=pack_address(new_address),
+                status=(STATUS_IPADDRESS, ip_address.pk),
+                force=force,
             )
 
             updated_names.append(new_dns_name)
@@ -142,9 +146,10 @@ class IPAddressDNSNameRecreateView(PermissionRequiredMixin, View):
 
             dns_create.delay(
                 dns_name=new_dns_name,
-                address=new_address,
-                status=extra,
+                address=pack_address(new_address),
+                status=status_ref(extra),
                 reverse=False,
+                force=force,
             )
 
             updated_names.append(new_dns_name)
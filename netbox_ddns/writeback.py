@@ -0,0 +1,149 @@
+import atexit
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+from django.utils import timezone
+
+from .metrics import metrics
+from .models import DNSStatus, ExtraDNSName
+from .utils import get_config
+
+logger = logging.getLogger('netbox_ddns')
+
+# The fields that background jobs change on each kind of status object
+STATUS_FIELDS = {
+    DNSStatus: ['last_update', 'forward_action', 'forward_rcode', 'forward_fingerprint', 'reverse_action',
+                'reverse_rcode', 'reverse_fingerprint'],
+    ExtraDNSName: ['last_update', 'forward_action', 'forward_rcode', 'forward_fingerprint'],
+}
+
+# The fields that identify the records that were last added successfully, see batch.record_fingerprint()
+FINGERPRINT_FIELDS = {
+    DNSStatus: ['forward_fingerprint', 'reverse_fingerprint'],
+    ExtraDNSName: ['forward_fingerprint'],
+}
+
+Status = Union[DNSStatus, ExtraDNSName]
+
+
+class StatusWriter(threading.local):
+    """
+    Collects the results of updates and writes them to the database in bulk, when enough have been collected, when
+    the oldest has waited long enough, and when the outermost batch ends. Every job runs inside a batch, so nothing
+    is left behind when a worker finishes a job, even though forked work horses never run exit handlers. This also
+    means results are never buffered across jobs, only jobs that update many records gain from writing in bulk.
+    """
+
+    def __init__(self):
+        self.pending: Dict[Tuple[type, object], Status] = {}
+        self.first_added = None
+        self.depth = 0
+
+    @staticmethod
+    def _key(status: Status) -> Tuple[type, object]:
+        if status.pk is None and isinstance(status, DNSStatus):
+            # Not created yet, DNSStatus is unique per IP address
+            return DNSStatus, ('ip_address', status.ip_address_id)
+        return type(status), status.pk
+
+    def add(self, status: Status):
+        if not self.pending:
+            self.first_added = time.monotonic()
+
+        # The same object may show up multiple times, its latest state is what gets written
+        self.pending[self._key(status)] = status
+
+        if self.depth == 0:
+            self.flush()
+        elif len(self.pending) >= get_config('status_flush_size') or \
+                time.monotonic() - self.first_added >= get_config('status_flush_interval'):
+            self.flush()
+
+    @contextmanager
+    def batch(self):
+        """
+        Buffer all results until the outermost batch ends, unless a flush is triggered earlier
+        """
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.flush()
+
+    def forget_fingerprints(self, fingerprints: Set[str], statuses: Iterable[Status] = ()):
+        """
+        Clear the fingerprints of deleted records on the given statuses, on the waiting ones and in the database, so
+        no status that shares the record skips adding it again
+        """
+        for status in itertools.chain(statuses, self.pending.values()):
+            for field in FINGERPRINT_FIELDS[type(status)]:
+                if getattr(status, field) in fingerprints:
+                    setattr(status, field, '')
+
+        # The fingerprint fields are indexed, so these are lookups rather than table scans
+        with metrics.phase('status_save'):
+            for model, fields in FINGERPRINT_FIELDS.items():
+                for field in fields:
+                    model.objects.filter(**{f'{field}__in': fingerprints}).update(**{field: ''})
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        pending = list(self.pending.values())
+        self.pending = {}
+        self.first_added = None
+
+        with metrics.phase('status_save'):
+            self._write(pending)
+
+        logger.debug(f"Saved {len(pending)} DNS status results")
+
+    @staticmethod
+    def _write(pending: List[Status]):
+        # bulk_update() doesn't apply auto_now, so set the timestamp here
+        now = timezone.now()
+        for status in pending:
+            status.last_update = now
+
+        for model, fields in STATUS_FIELDS.items():
+            # Only the fields this worker changed are written, so results that another job saved for the other
+            # fields in the meantime are kept. Statuses that changed the same fields are updated together.
+            changed: Dict[Tuple[str, ...], List[Status]] = defaultdict(list)
+            for status in pending:
+                if isinstance(status, model) and status.pk is not None:
+                    changed[tuple(status.changed_fields(fields))].append(status)
+
+            for changed_fields, statuses in changed.items():
+                model.objects.bulk_update(statuses, changed_fields, batch_size=get_config('status_flush_size'))
+
+        new = [status for status in pending if isinstance(status, DNSStatus) and status.pk is None]
+        if new:
+            DNSStatus.objects.bulk_create(
+                new,
+                update_conflicts=True,
+                unique_fields=['ip_address'],
+                update_fields=STATUS_FIELDS[DNSStatus],
+            )
+
+        for status in pending:
+            status.mark_saved(STATUS_FIELDS[type(status)])
+
+
+status_writer = StatusWriter()
+
+
+@atexit.register
+def _flush_on_exit():
+    # Workers that don't fork run jobs in the main thread, flush whatever a crashed job might have left
+    try:
+        status_writer.flush()
+    except Exception:
+        logger.exception("Couldn't save DNS status results on exit")